@@ -0,0 +1,127 @@
+import os
+import time
+import asyncio
+import hashlib
+import multiprocessing
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from logger_config import setup_logger
+from preprocess_data import merge_pair
+from detector import train_model_for_sensor
+from zscore import detach_worker
+
+logger = setup_logger(__name__)
+
+BACKFILL_WORKERS = int(os.getenv("BACKFILL_WORKERS", os.cpu_count() or 2))
+# Seconds without a new historical pair before the collected backlog is trained
+BACKFILL_IDLE_SECONDS = float(os.getenv("BACKFILL_IDLE_SECONDS", 10))
+
+
+def fingerprint(job):
+    # Identifies the exact training window, so a re-sent upload is not trained twice
+    sp, pv, prefix, mode, topic, outdoor = job
+    digest = hashlib.blake2b(prefix.encode(), digest_size=16)
+    for series in (sp, pv, outdoor):
+        if series is None:
+            continue
+        for array in series:
+            digest.update(array.tobytes())
+    return digest.hexdigest()
+
+
+def train_pair(job):
+    # Runs in a backfill worker process; returns the prefix and its training time
+    sp, pv, prefix, mode, topic, outdoor = job
+    start = time.perf_counter()
+    df = merge_pair(sp, pv, prefix, topic, outdoor)
+    train_model_for_sensor(df, f"{prefix}_CSP", f"{prefix}_PV", topic)
+    return prefix, time.perf_counter() - start
+
+
+class BackfillTrainer:
+    # Collects historical pairs from every topic consumer and trains them together,
+    # fanned out over a process pool once uploads have gone quiet.
+    def __init__(self, workers=BACKFILL_WORKERS, idle_seconds=BACKFILL_IDLE_SECONDS):
+        self.workers = workers
+        self.idle_seconds = idle_seconds
+        self.jobs = OrderedDict()  # prefix -> (fingerprint, job), newest window wins
+        self.trained = {}  # prefix -> fingerprint of the last trained window
+        self.last_added = None
+        self.duplicates = 0
+        self.progress = {"total": 0, "done": 0, "failed": 0, "timings": {}}
+        self._executor = None
+
+    def add(self, job):
+        prefix = job[2]
+        key = fingerprint(job)
+        queued = self.jobs.get(prefix)
+        if self.trained.get(prefix) == key or (queued is not None and queued[0] == key):
+            self.duplicates += 1
+            logger.info("Skipping duplicate historical window for %s", prefix)
+            return False
+        self.jobs[prefix] = (key, job)
+        self.jobs.move_to_end(prefix)
+        self.last_added = time.monotonic()
+        return True
+
+    def due(self):
+        return bool(self.jobs) and time.monotonic() - self.last_added >= self.idle_seconds
+
+    def _pool(self):
+        if self._executor is None:
+            # spawn keeps the workers clear of the consumer's threads and open sockets
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.workers, mp_context=multiprocessing.get_context("spawn"), initializer=detach_worker
+            )
+        return self._executor
+
+    async def run(self):
+        batch = list(self.jobs.items())
+        self.jobs.clear()
+        if not batch:
+            return self.progress
+
+        loop = asyncio.get_running_loop()
+        pool = self._pool()
+        self.progress = {"total": len(batch), "done": 0, "failed": 0, "timings": {}}
+        logger.info("Backfill: training %s sensors on %s workers", len(batch), self.workers)
+        start = time.perf_counter()
+
+        keys = {prefix: key for prefix, (key, job) in batch}
+        futures = [loop.run_in_executor(pool, train_pair, job) for prefix, (key, job) in batch]
+        broken = False
+        for future in asyncio.as_completed(futures):
+            try:
+                prefix, seconds = await future
+            except BrokenProcessPool as e:
+                broken = True
+                self.progress["failed"] += 1
+                logger.error("Backfill: worker process died: %s", e)
+                continue
+            except Exception as e:
+                self.progress["failed"] += 1
+                logger.error("Backfill: training failed: %s", e, exc_info=e)
+                continue
+            self.progress["done"] += 1
+            self.progress["timings"][prefix] = seconds
+            self.trained[prefix] = keys[prefix]
+            logger.info("Backfill: %s/%s trained, %s took %.2fs", self.progress["done"], len(batch), prefix, seconds)
+
+        if broken:
+            # Start from a fresh pool next time instead of failing every job
+            self.close()
+        logger.info("Backfill finished in %.1fs: %s trained, %s failed, %s duplicates skipped",
+                    time.perf_counter() - start, self.progress["done"], self.progress["failed"], self.duplicates)
+        return self.progress
+
+    async def serve(self, poll_interval=1.0):
+        while True:
+            if self.due():
+                await self.run()
+            await asyncio.sleep(poll_interval)
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
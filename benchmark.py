@@ -0,0 +1,560 @@
+# End-to-end throughput benchmark for volga_consumer.consume_topic.
+#
+# Replays synthetic CSP/PV/outdoor payloads through a local stand-in for the Avassa
+# Volga consumer and reports messages/sec, receive-to-flush latency, peak RSS and
+# event-loop lag as JSON, e.g.
+#
+#   python benchmark.py --sensors 40 --rounds 50 --rate 0 --output bench.json
+#
+# With --scorer it instead checks that the compiled forest makes the same decisions as
+# IsolationForest.predict and compares per-call scoring latency. With --join it checks
+# merge_pair against the pandas merge_asof/interpolate pipeline it replaced and times both.
+# With --timestamps it checks payload timestamp parsing against pd.to_datetime, and with
+# --failover that a supervised shard whose consumer fails exits and is restarted. --gate
+# reports how many anomalies the z-score gate would keep from the IsolationForest.
+
+import os
+import sys
+import json
+import logging
+import time
+import types
+import random
+import asyncio
+import argparse
+import resource
+import tempfile
+from datetime import datetime, timedelta, timezone
+
+os.environ.setdefault("WRITE_DELAY", "1")
+
+import numpy as np
+import pandas as pd
+
+
+def install_fake_avassa():
+    # volga_consumer imports avassa_client at module level; outside the edge image we
+    # register a minimal stand-in so the consumer can be driven locally
+    try:
+        import avassa_client.volga  # noqa: F401
+        return
+    except ImportError:
+        pass
+    avassa = types.ModuleType("avassa_client")
+    avassa.approle_login = lambda **kwargs: None
+    volga = types.ModuleType("avassa_client.volga")
+    for name in ("Consumer", "Topic", "CreateOptions", "Position"):
+        setattr(volga, name, type(name, (), {}))
+    avassa.volga = volga
+    sys.modules["avassa_client"] = avassa
+    sys.modules["avassa_client.volga"] = volga
+
+
+class FakeTopic:
+    @staticmethod
+    def local(name):
+        return name
+
+
+class FakePosition:
+    @staticmethod
+    def end():
+        return "end"
+
+
+class FakeCreateOptions:
+    @staticmethod
+    def wait():
+        return "wait"
+
+
+def sensor_prefixes(n_sensors):
+    # Same subsystem as the default OUTDOOR_TEMP_TAG so heating pairs get the outdoor feature
+    return [f"1473_04_AS01_VS01_GT{i:03d}" for i in range(n_sensors)]
+
+
+def make_messages(topic_name, n_sensors, rounds, start, outdoor_tag):
+    # One CSP and one PV payload per sensor per round, plus outdoor temperature for heating topics
+    rng = random.Random(0)
+    messages = []
+    for r in range(rounds):
+        ts = (start + timedelta(minutes=r)).isoformat()
+        if "heating" in topic_name.lower():
+            messages.append((None, ts, {"payload": {outdoor_tag: {ts: rng.uniform(-20, 10)}, "mode": "realtime"}}))
+        for prefix in sensor_prefixes(n_sensors):
+            setpoint = 21.0 + rng.uniform(-0.5, 0.5)
+            messages.append((prefix, ts, {"payload": {f"{prefix}_CSP": {ts: setpoint}, "mode": "realtime"}}))
+            messages.append((prefix, ts, {"payload": {f"{prefix}_PV": {ts: setpoint + rng.gauss(0, 0.3)}, "mode": "realtime"}}))
+    return messages
+
+
+class FakeConsumer:
+    # Stand-in for avassa_client.volga.Consumer that replays prepared messages,
+    # honouring credits granted with more() the way the Volga server does
+    def __init__(self, messages, rate, received):
+        self.messages = messages
+        self.rate = rate
+        self.received = received  # (prefix, timestamp) -> monotonic receive time
+        self.index = 0
+        self.credits = 0
+        self.credit_granted = None
+        self.started = None
+        self.finished = None
+
+    def __call__(self, **kwargs):
+        return self
+
+    async def __aenter__(self):
+        self.credit_granted = asyncio.Event()
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+    async def more(self, n):
+        self.credits += n
+        self.credit_granted.set()
+
+    async def recv(self, auto_more=10):
+        if self.index >= len(self.messages):
+            await asyncio.Future()  # block like an idle topic
+        while self.credits <= 0:
+            self.credit_granted.clear()
+            await self.credit_granted.wait()
+        if self.started is None:
+            self.started = time.monotonic()
+        if self.rate > 0:
+            due = self.started + self.index / self.rate
+            delay = due - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        prefix, ts, msg = self.messages[self.index]
+        self.index += 1
+        self.credits -= 1
+        now = time.monotonic()
+        if self.index == len(self.messages):
+            self.finished = now
+        if prefix is not None:
+            self.received[(prefix, pd.Timestamp(ts).value)] = now
+        msg = dict(msg)
+        msg["remain"] = self.credits
+        if auto_more and self.credits == 0:
+            await self.more(auto_more)
+        return msg
+
+
+class FailingConsumer(FakeConsumer):
+    # Replays its messages, then fails the way a broken Volga stream does
+    async def recv(self, auto_more=10):
+        if self.index >= len(self.messages):
+            raise ConnectionError("Volga stream closed")
+        return await super().recv(auto_more)
+
+
+class LoopLagProbe:
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.lags = []
+
+    async def run(self):
+        while True:
+            start = time.monotonic()
+            await asyncio.sleep(self.interval)
+            self.lags.append(max(0.0, time.monotonic() - start - self.interval))
+
+
+def pretrain(prefixes, topic_name, start):
+    from detector import train_model_for_sensor
+
+    rng = np.random.default_rng(0)
+    timestamps = pd.date_range(end=start, periods=500, freq="min")
+    for prefix in prefixes:
+        setpoint = 21.0 + rng.uniform(-0.5, 0.5, len(timestamps))
+        df = pd.DataFrame({
+            "Timestamp": timestamps,
+            f"SetPoint_{prefix}_CSP": setpoint,
+            f"Actual_{prefix}_PV": setpoint + rng.normal(0, 0.3, len(timestamps)),
+        })
+        if "heating" in topic_name.lower():
+            df["Outdoor_Temperature"] = rng.uniform(-20, 10, len(timestamps))
+        train_model_for_sensor(df, f"{prefix}_CSP", f"{prefix}_PV", topic_name)
+
+
+def percentile(values, q, scale=1.0):
+    return float(np.percentile(values, q)) * scale if values else None
+
+
+async def run_benchmark(args):
+    install_fake_avassa()
+    import volga_consumer
+    from pipeline import create_executor
+    from metrics import registry, stage_summary
+
+    start = datetime(2025, 1, 1, tzinfo=timezone.utc)
+    prefixes = sensor_prefixes(args.sensors)
+    if not args.skip_training:
+        pretrain(prefixes, args.topic, start)
+
+    received = {}
+    flushed = {}
+    messages = make_messages(args.topic, args.sensors, args.rounds, start, os.getenv("OUTDOOR_TEMP_TAG", "1473_04_AS01_VS01_GT300_PV"))
+    consumer = FakeConsumer(messages, args.rate, received)
+    expected_rows = args.sensors * args.rounds
+
+    open_store = volga_consumer.open_store
+
+    def timed_store(topic_name, capacity):
+        store = open_store(topic_name, capacity)
+        append = store.append
+
+        def append_and_record(rows):
+            append(rows)
+            now = time.monotonic()
+            for row in rows:
+                flushed.setdefault((row.sensor, row.timestamp), now)
+
+        store.append = append_and_record
+        return store
+
+    volga_consumer.Consumer = consumer
+    volga_consumer.Topic = FakeTopic
+    volga_consumer.Position = FakePosition
+    volga_consumer.CreateOptions = FakeCreateOptions
+    volga_consumer.open_store = timed_store
+
+    executor = create_executor()
+    probe = LoopLagProbe()
+    probe_task = asyncio.create_task(probe.run())
+    consume_task = asyncio.create_task(volga_consumer.consume_topic(args.topic, None, executor))
+
+    began = time.monotonic()
+    deadline = began + args.timeout
+    while len(flushed) < expected_rows and time.monotonic() < deadline:
+        await asyncio.sleep(0.05)
+    elapsed = time.monotonic() - began
+
+    consume_task.cancel()
+    probe_task.cancel()
+    await asyncio.gather(consume_task, probe_task, return_exceptions=True)
+    if executor is not None:
+        executor.shutdown(wait=True)
+
+    receive_seconds = None
+    if consumer.started is not None:
+        receive_seconds = (consumer.finished or time.monotonic()) - consumer.started
+    latencies = [flushed[key] - received[key] for key in flushed if key in received]
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return {
+        "topic": args.topic,
+        "sensors": args.sensors,
+        "rounds": args.rounds,
+        "target_rate": args.rate,
+        "messages": consumer.index,
+        "rows_flushed": len(flushed),
+        "rows_expected": expected_rows,
+        "elapsed_seconds": elapsed,
+        "receive_seconds": receive_seconds,
+        "messages_per_second": consumer.index / receive_seconds if receive_seconds else None,
+        "latency_p50_seconds": percentile(latencies, 50),
+        "latency_p99_seconds": percentile(latencies, 99),
+        "peak_rss_mb": usage.ru_maxrss / 1024,
+        "loop_lag_p50_ms": percentile(probe.lags, 50, 1000),
+        "loop_lag_p99_ms": percentile(probe.lags, 99, 1000),
+        "loop_lag_max_ms": max(probe.lags) * 1000 if probe.lags else None,
+        "stages": stage_summary(registry.snapshot()),
+    }
+
+
+def parity_rows(rng, n, start, topic_name, sp_tag, pv_tag):
+    # Rows from the training window, with a tenth pushed well away from the setpoint
+    setpoint = 21.0 + rng.uniform(-0.5, 0.5, n)
+    actual = setpoint + rng.normal(0, 0.3, n) + (rng.random(n) < 0.1) * rng.normal(0, 3.0, n)
+    df = pd.DataFrame({
+        "Timestamp": pd.date_range(start - timedelta(minutes=499), start, periods=n),
+        f"SetPoint_{sp_tag}": setpoint,
+        f"Actual_{pv_tag}": actual,
+    })
+    if "heating" in topic_name.lower():
+        df["Outdoor_Temperature"] = rng.uniform(-25, 15, n)
+    return df
+
+
+def gate_benchmark(args):
+    # Anomalies the z-score gate would hide from the IsolationForest, fed one realtime row
+    # at a time with the configured threshold and sample rate
+    from detector import build_features, model_registry
+    from features import feature_frame, ERROR
+    from zscore import ZScoreTracker, ZSCORE_GATE_THRESHOLD, ZSCORE_SAMPLE_RATE
+
+    start = datetime(2025, 1, 1, tzinfo=timezone.utc)
+    prefix = sensor_prefixes(1)[0]
+    sp_tag, pv_tag = f"{prefix}_CSP", f"{prefix}_PV"
+    pretrain([prefix], args.topic, start)
+    model = model_registry.get(sp_tag)
+
+    df = parity_rows(np.random.default_rng(1), args.parity_rows, start, args.topic, sp_tag, pv_tag)
+    X, names = build_features(df, sp_tag, pv_tag, args.topic)
+    flagged = model.predict(feature_frame(X, names)) == -1
+
+    tracker = ZScoreTracker(path="gate_state.npz")
+    send = np.concatenate([tracker.gate(sp_tag, X[i:i + 1, ERROR]) for i in range(len(X))])
+    kept = int((flagged & send).sum())
+    total = int(flagged.sum())
+    recall = kept / total if total else 1.0
+    return {
+        "topic": args.topic,
+        "parity_rows": len(X),
+        "threshold": ZSCORE_GATE_THRESHOLD,
+        "sample_rate": ZSCORE_SAMPLE_RATE,
+        "model_share": float(send.mean()),
+        "anomalies": total,
+        "lost_anomalies": total - kept,
+        "recall": recall,
+        "min_recall": args.min_recall,
+        "failed": recall < args.min_recall,
+    }
+
+
+def scorer_benchmark(args):
+    # Parity and per-call latency of the compiled forest against IsolationForest.predict
+    from detector import train_model_for_sensor, build_features, model_registry
+    from features import feature_frame
+    from compiled_forest import compiled_registry
+
+    start = datetime(2025, 1, 1, tzinfo=timezone.utc)
+    prefix = sensor_prefixes(1)[0]
+    sp_tag, pv_tag = f"{prefix}_CSP", f"{prefix}_PV"
+    pretrain([prefix], args.topic, start)
+    model = model_registry.get(sp_tag)
+    compiled = compiled_registry.get(sp_tag)
+
+    n = args.parity_rows
+    df = parity_rows(np.random.default_rng(1), n, start, args.topic, sp_tag, pv_tag)
+    X = feature_frame(*build_features(df, sp_tag, pv_tag, args.topic))
+
+    expected = model.predict(X)
+    actual = compiled.predict(X)
+    score_diff = np.abs(model.decision_function(X) - compiled.decision_function(X)).max()
+
+    latency = {}
+    for rows in (1, 4, 32):
+        sample = X.iloc[:rows]
+        for name, scorer in (("sklearn", model), ("compiled", compiled)):
+            timings = []
+            for _ in range(args.repeat):
+                t0 = time.perf_counter()
+                scorer.predict(sample)
+                timings.append(time.perf_counter() - t0)
+            latency[f"{name}_{rows}_rows_p50_ms"] = percentile(timings, 50, 1000)
+            latency[f"{name}_{rows}_rows_p99_ms"] = percentile(timings, 99, 1000)
+
+    return {
+        "topic": args.topic,
+        "parity_rows": n,
+        "outliers": int((expected == -1).sum()),
+        "mismatches": int((expected != actual).sum()),
+        "max_decision_diff": float(score_diff),
+        "decision_tolerance": args.decision_tolerance,
+        "latency": latency,
+    }
+
+
+def reference_merge(sp, pv, tag_name, topic_name=None, outdoor=None):
+    # The merge_asof/dropna/interpolate/bfill/ffill sequence merge_pair must reproduce
+    def frame(series, column):
+        order = np.argsort(series[0], kind="stable")
+        return pd.DataFrame({
+            "Timestamp": pd.to_datetime(series[0][order], utc=True),
+            column: series[1][order].astype(np.float64),
+        })
+
+    df = pd.merge_asof(
+        frame(sp, f"SetPoint_{tag_name}_CSP"), frame(pv, f"Actual_{tag_name}_PV"),
+        on="Timestamp", direction="nearest", tolerance=pd.Timedelta("300s"),
+    )
+    if topic_name and "heating" in topic_name.lower() and outdoor is not None and len(outdoor[0]):
+        df = pd.merge_asof(
+            df, frame(outdoor, "Outdoor_Temperature"),
+            on="Timestamp", direction="nearest", tolerance=pd.Timedelta("60s"),
+        )
+    df = df.dropna(subset=[f"SetPoint_{tag_name}_CSP", f"Actual_{tag_name}_PV"], how="all")
+    df = df.sort_values("Timestamp", kind="stable").interpolate(limit=2)
+    return df.bfill(limit=1).ffill(limit=1)
+
+
+def random_series(rng, start_ns, n, step_s, jitter_s, nan_rate):
+    # Irregular timestamps with occasional repeats, runs of NaN and long outages
+    steps = rng.exponential(step_s, n) + rng.uniform(0, jitter_s, n)
+    steps[rng.random(n) < 0.02] *= 20
+    steps[rng.random(n) < 0.02] = 0
+    timestamps = start_ns + np.cumsum(steps * 1e9).astype(np.int64)
+    values = rng.normal(21.0, 1.0, n)
+    values[rng.random(n) < nan_rate] = np.nan
+    for _ in range(rng.integers(0, 3) if n else 0):
+        gap = rng.integers(0, n)
+        values[gap:gap + rng.integers(1, 6)] = np.nan
+    order = rng.permutation(n) if rng.random() < 0.2 else np.arange(n)
+    return timestamps[order], values[order]
+
+
+def join_benchmark(args):
+    # Parity of merge_pair with reference_merge on randomised pairs, and time per pair
+    from preprocess_data import merge_pair
+    from config import OUTDOOR_TEMP_TAG
+
+    rng = np.random.default_rng(2)
+    start_ns = pd.Timestamp("2025-01-01", tz="UTC").value
+    topic = "bench-heating" if OUTDOOR_TEMP_TAG else args.topic
+    pairs = []
+    for _ in range(args.repeat):
+        n = int(rng.integers(1, 200))
+        sp = random_series(rng, start_ns, n, 60, 30, rng.choice([0.0, 0.05, 0.3]))
+        pv = random_series(rng, start_ns, int(rng.integers(1, 2 * n + 1)), 60, 240, rng.choice([0.0, 0.05, 0.3]))
+        ts, vals = random_series(rng, start_ns - 3_600_000_000_000, 400, 30, 30, 0.05)
+        order = np.argsort(ts, kind="stable")
+        ts, vals = ts[order], vals[order].astype(np.float32)
+        keep = np.append(ts[1:] != ts[:-1], True)
+        pairs.append((sp, pv, (ts[keep], vals[keep])))
+
+    mismatches = 0
+    for sp, pv, outdoor in pairs:
+        expected = reference_merge(sp, pv, "T", topic, outdoor).reset_index(drop=True)
+        got = merge_pair(sp, pv, "T", topic, outdoor)
+        try:
+            pd.testing.assert_frame_equal(got, expected, check_dtype=False)
+        except AssertionError:
+            mismatches += 1
+
+    timings = {}
+    for name, merge in (("pandas", reference_merge), ("join_engine", merge_pair)):
+        t0 = time.perf_counter()
+        for sp, pv, outdoor in pairs:
+            merge(sp, pv, "T", topic, outdoor)
+        timings[f"{name}_per_pair_ms"] = (time.perf_counter() - t0) * 1000 / len(pairs)
+
+    return {"topic": topic, "pairs": len(pairs), "mismatches": mismatches, **timings}
+
+
+def failover_benchmark(args):
+    # A shard whose consumer fails must exit non-zero, and the supervisor must start it again
+    install_fake_avassa()
+    import volga_consumer
+    import supervisor
+
+    start = datetime(2025, 1, 1, tzinfo=timezone.utc)
+    messages = make_messages(args.topic, args.sensors, 2, start, os.getenv("OUTDOOR_TEMP_TAG", "1473_04_AS01_VS01_GT300_PV"))
+    volga_consumer.Consumer = FailingConsumer(messages, 0, {})
+    volga_consumer.Topic = FakeTopic
+    volga_consumer.Position = FakePosition
+    volga_consumer.CreateOptions = FakeCreateOptions
+
+    sup = supervisor.Supervisor([[args.topic]], session=None)
+    worker = sup.workers[0]
+    sup.start(worker)
+    worker.process.join(args.timeout)
+    exitcode = worker.process.exitcode
+    sup.check(time.monotonic())
+    scheduled = worker.restart_at is not None
+    if scheduled:
+        sup.check(worker.restart_at)
+    restarted = worker.alive() or worker.process.exitcode is None
+    sup.stop()
+
+    return {
+        "topic": args.topic,
+        "exitcode": exitcode,
+        "restart_scheduled": scheduled,
+        "restarted": restarted,
+        "failed": exitcode in (0, None) or not (scheduled and restarted),
+    }
+
+
+def timestamp_benchmark(args):
+    # parse_series against pd.to_datetime for one-point (realtime) and multi-point
+    # (historical) payloads, in ISO 8601 and in a day-first layout
+    import helper
+
+    rng = np.random.default_rng(3)
+    start = pd.Timestamp("2025-01-01", tz="UTC")
+    layouts = {"ISO8601": None, "%d/%m/%Y %H:%M": "%d/%m/%Y %H:%M"}
+    mismatches = 0
+    payloads = 0
+    default_format = helper.TIMESTAMP_FORMAT
+    try:
+        for layout, strftime in layouts.items():
+            helper.TIMESTAMP_FORMAT = layout
+            for _ in range(args.repeat):
+                n = 1 if rng.random() < 0.5 else int(rng.integers(2, 200))
+                times = start + pd.to_timedelta(np.sort(rng.choice(365 * 24 * 60, n, replace=False)), unit="min")
+                keys = [t.isoformat() if strftime is None else t.strftime(strftime) for t in times]
+                expected = pd.to_datetime(keys, utc=True, format=layout).as_unit("ns").asi8
+                got, _ = helper.parse_series(dict.fromkeys(keys, 21.0))
+                mismatches += int(not np.array_equal(got, expected))
+                payloads += 1
+    finally:
+        helper.TIMESTAMP_FORMAT = default_format
+
+    return {"payloads": payloads, "layouts": list(layouts), "mismatches": mismatches}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Throughput benchmark for volga_consumer.consume_topic")
+    parser.add_argument("--topic", default="bench-ventilation")
+    parser.add_argument("--sensors", type=int, default=20)
+    parser.add_argument("--rounds", type=int, default=20)
+    parser.add_argument("--rate", type=float, default=0, help="messages per second, 0 for as fast as possible")
+    parser.add_argument("--timeout", type=float, default=120)
+    parser.add_argument("--skip-training", action="store_true")
+    parser.add_argument("--workdir", help="directory for models and stores (default: a temporary directory)")
+    parser.add_argument("--output", help="write the JSON result here as well as to stdout")
+    parser.add_argument("--verbose", action="store_true", help="keep the pipeline's INFO logging")
+    parser.add_argument("--scorer", action="store_true",
+                        help="check compiled forest parity and per-call latency against IsolationForest.predict instead")
+    parser.add_argument("--join", action="store_true",
+                        help="check merge_pair parity with the pandas merge it replaced and time both instead")
+    parser.add_argument("--timestamps", action="store_true",
+                        help="check parse_series against pd.to_datetime for ISO and day-first payloads instead")
+    parser.add_argument("--gate", action="store_true",
+                        help="check how many IsolationForest anomalies the z-score gate would skip instead")
+    parser.add_argument("--min-recall", type=float, default=1.0, help="share of anomalies --gate must keep")
+    parser.add_argument("--failover", action="store_true",
+                        help="check that a shard whose consumer fails exits and is restarted by the supervisor instead")
+    parser.add_argument("--decision-tolerance", type=float, default=1e-9,
+                        help="largest decision_function difference --scorer accepts")
+    parser.add_argument("--parity-rows", type=int, default=20000)
+    parser.add_argument("--repeat", type=int, default=500)
+    args = parser.parse_args()
+
+    if not args.verbose:
+        logging.disable(logging.INFO)
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix="bms-bench-")
+    os.makedirs(workdir, exist_ok=True)
+    output = os.path.abspath(args.output) if args.output else None
+    os.chdir(workdir)
+
+    if args.scorer:
+        result = scorer_benchmark(args)
+    elif args.join:
+        result = join_benchmark(args)
+    elif args.timestamps:
+        result = timestamp_benchmark(args)
+    elif args.failover:
+        result = failover_benchmark(args)
+    elif args.gate:
+        result = gate_benchmark(args)
+    else:
+        result = asyncio.run(run_benchmark(args))
+    result["workdir"] = workdir
+    text = json.dumps(result, indent=2)
+    print(text)
+    if output:
+        with open(output, "w") as f:
+            f.write(text + "\n")
+    # The parity modes stand in for tests, so a mismatch has to fail the run
+    if result.get("mismatches") or result.get("failed") or result.get("max_decision_diff", 0.0) > args.decision_tolerance:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
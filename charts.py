@@ -0,0 +1,73 @@
+import os
+import numpy as np
+import altair as alt
+
+# Points kept per sensor and series in the combined chart: one min/max pair per couple
+# of pixels of an 800px wide facet
+CHART_MAX_POINTS = int(os.getenv("CHART_MAX_POINTS", 400))
+CHART_FACET_COLUMNS = int(os.getenv("CHART_FACET_COLUMNS", 2))
+CHART_FACET_HEIGHT = int(os.getenv("CHART_FACET_HEIGHT", 160))
+
+VALUE_COLUMNS = ["Actual", "SetPoint"]
+
+
+def _bucket_extremes(values, max_points):
+    # Positions of the min and max of each bucket, for each column of `values` (n x k).
+    # Buckets are equal-sized runs of consecutive rows; the tail is padded with NaN.
+    n = len(values)
+    buckets = max(1, max_points // 2)
+    size = -(-n // buckets)
+    buckets = -(-n // size)
+    padded = np.full((buckets * size, values.shape[1]), np.nan)
+    padded[:n] = values
+    padded = padded.reshape(buckets, size, values.shape[1])
+    # A bucket that is all NaN (a gap in the data) contributes its first row
+    filled = np.where(np.isnan(padded).all(axis=1, keepdims=True), 0.0, padded)
+    offsets = np.arange(buckets)[:, None] * size
+    lows = np.nanargmin(filled, axis=1) + offsets
+    highs = np.nanargmax(filled, axis=1) + offsets
+    return np.concatenate([lows.ravel(), highs.ravel()])
+
+
+def downsample(frame, max_points=CHART_MAX_POINTS):
+    # Rows to draw per sensor: first, last, each bucket's min and max of every value
+    # column, and every anomaly. Sensors with few rows are kept whole.
+    keep = []
+    anomalies = frame["Anomaly"].to_numpy(dtype=bool) if "Anomaly" in frame else np.zeros(len(frame), dtype=bool)
+    values = frame[VALUE_COLUMNS].to_numpy(dtype=np.float64)
+    for positions in frame.groupby("Sensor", sort=False).indices.values():
+        if len(positions) <= max_points:
+            keep.append(positions)
+            continue
+        picked = positions[_bucket_extremes(values[positions], max_points)]
+        keep.append(np.concatenate([positions[[0, -1]], picked, positions[anomalies[positions]]]))
+    if not keep:
+        return frame
+    return frame.iloc[np.unique(np.concatenate(keep))]
+
+
+def faceted_chart(frame, max_points=CHART_MAX_POINTS, columns=CHART_FACET_COLUMNS, height=CHART_FACET_HEIGHT):
+    # One small-multiples chart for a whole subsystem, built from downsampled rows
+    sampled = downsample(frame, max_points)
+    melted = sampled.melt(
+        id_vars=["Timestamp", "Sensor", "Anomaly"],
+        value_vars=VALUE_COLUMNS,
+        var_name="Type",
+        value_name="Value"
+    )
+    tooltip = [alt.Tooltip("Timestamp:T", title="Time", format="%H:%M"), "Value:Q", "Anomaly:O"]
+    base = alt.Chart().encode(
+        x=alt.X("Timestamp:T", title="Time", axis=alt.Axis(format="%H:%M", tickCount=5)),
+        y=alt.Y("Value:Q", title="Value", scale=alt.Scale(zero=False)),
+        color=alt.Color("Type:N"),
+    )
+    # invalid=None breaks the line at missing values instead of joining across them
+    lines = base.mark_line(interpolate="monotone", invalid=None).encode(strokeDash=alt.StrokeDash("Type:N"), tooltip=tooltip)
+    anomaly_points = base.transform_filter(alt.datum.Anomaly == True).mark_point(
+        color="red", filled=True, size=75
+    ).encode(tooltip=tooltip)
+
+    chart = alt.layer(lines, anomaly_points, data=melted).properties(height=height).facet(
+        facet=alt.Facet("Sensor:N", title=None), columns=columns
+    ).resolve_scale(y="independent", x="independent")
+    return chart.configure_view(strokeWidth=0).configure(background="transparent")
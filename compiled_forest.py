@@ -0,0 +1,137 @@
+import os
+import numpy as np
+
+from model_registry import ModelRegistry, MODEL_CACHE_SIZE, MODEL_MISSING_TTL
+from storage import atomic_write
+
+# Score realtime rows with the flattened forest instead of IsolationForest.predict when available
+ISF_COMPILED = os.getenv("ISF_COMPILED", "true").lower() == "true"
+
+FORMAT_VERSION = 1
+
+
+def compiled_path(sp_tag):
+    return f"{sp_tag}_model.npz"
+
+
+def _average_path_length(n):
+    # sklearn.ensemble._iforest._average_path_length, elementwise
+    n = np.asarray(n, dtype=np.float64)
+    out = np.zeros_like(n)
+    out[n == 2] = 1.0
+    big = n > 2
+    out[big] = 2.0 * (np.log(n[big] - 1.0) + np.euler_gamma) - 2.0 * (n[big] - 1.0) / n[big]
+    return out
+
+
+class CompiledForest:
+    # A fitted IsolationForest flattened into contiguous node arrays. All trees are
+    # walked together, one level per step, so scoring a handful of rows costs a few
+    # NumPy calls instead of sklearn's validation and per-tree dispatch. Decisions
+    # match IsolationForest.predict: X is cast to float32 as sklearn does, and the
+    # per-tree path lengths are accumulated in tree order.
+    def __init__(self, feature, threshold, left, right, leaf_value, roots, max_depth,
+                 denominator, offset, feature_names, feature_schema=1):
+        self.feature = feature
+        self.threshold = threshold
+        self.left = left
+        self.right = right
+        self.leaf_value = leaf_value
+        self.roots = roots
+        self.max_depth = int(max_depth)
+        self.denominator = float(denominator)
+        self.offset_ = float(offset)
+        self.feature_names_in_ = feature_names
+        self.n_features_in_ = len(feature_names)
+        self.feature_schema_ = int(feature_schema)
+
+    @classmethod
+    def from_sklearn(cls, model):
+        features, thresholds, lefts, rights, leaf_values, roots = [], [], [], [], [], []
+        offset = 0
+        max_depth = 0
+        for tree_idx, (estimator, tree_features) in enumerate(zip(model.estimators_, model.estimators_features_)):
+            tree = estimator.tree_
+            n = tree.node_count
+            is_leaf = tree.children_left == -1
+            nodes = np.arange(n)
+            # Map the tree's feature subset back to model columns; leaves loop onto themselves
+            feature = np.where(is_leaf, 0, np.asarray(tree_features)[np.maximum(tree.feature, 0)])
+            features.append(feature)
+            thresholds.append(tree.threshold)
+            lefts.append(np.where(is_leaf, nodes, tree.children_left) + offset)
+            rights.append(np.where(is_leaf, nodes, tree.children_right) + offset)
+            leaf_values.append(
+                model._decision_path_lengths[tree_idx] + model._average_path_length_per_tree[tree_idx] - 1.0
+            )
+            roots.append(offset)
+            max_depth = max(max_depth, tree.max_depth)
+            offset += n
+
+        names = getattr(model, "feature_names_in_", None)
+        if names is None:
+            names = [f"x{i}" for i in range(model.n_features_in_)]
+        denominator = len(model.estimators_) * _average_path_length([model._max_samples])[0]
+        return cls(
+            np.concatenate(features).astype(np.int32),
+            np.concatenate(thresholds).astype(np.float64),
+            np.concatenate(lefts).astype(np.int32),
+            np.concatenate(rights).astype(np.int32),
+            np.concatenate(leaf_values).astype(np.float64),
+            np.asarray(roots, dtype=np.int32),
+            max_depth,
+            denominator,
+            model.offset_,
+            np.asarray(names, dtype=object),
+            getattr(model, "feature_schema_", 1),
+        )
+
+    def save(self, path):
+        with atomic_write(path) as f:
+            np.savez(
+                f, version=FORMAT_VERSION, feature=self.feature, threshold=self.threshold,
+                left=self.left, right=self.right, leaf_value=self.leaf_value, roots=self.roots,
+                max_depth=self.max_depth, denominator=self.denominator, offset=self.offset_,
+                feature_names=self.feature_names_in_.astype(str), feature_schema=self.feature_schema_,
+            )
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            if int(data["version"]) != FORMAT_VERSION:
+                raise ValueError(f"Unsupported compiled forest version in {path}")
+            return cls(
+                data["feature"], data["threshold"], data["left"], data["right"], data["leaf_value"],
+                data["roots"], data["max_depth"], data["denominator"], data["offset"],
+                data["feature_names"].astype(object),
+                data["feature_schema"] if "feature_schema" in data.files else 1,
+            )
+
+    def _depths(self, X):
+        rows = np.arange(len(X))[:, None]
+        nodes = np.broadcast_to(self.roots, (len(X), len(self.roots)))
+        for _ in range(self.max_depth):
+            go_left = X[rows, self.feature[nodes]] <= self.threshold[nodes]
+            nodes = np.where(go_left, self.left[nodes], self.right[nodes])
+        # cumsum adds tree by tree, the same order sklearn accumulates depths in
+        return np.cumsum(self.leaf_value[nodes], axis=1)[:, -1]
+
+    def score_samples(self, X):
+        X = np.asarray(X, dtype=np.float32)
+        if not len(X):
+            return np.empty(0)
+        depths = self._depths(X)
+        ratio = np.divide(depths, self.denominator, out=np.ones_like(depths), where=self.denominator != 0)
+        return -(2 ** -ratio)
+
+    def decision_function(self, X):
+        return self.score_samples(X) - self.offset_
+
+    def predict(self, X):
+        decision = self.decision_function(X)
+        is_inlier = np.ones_like(decision, dtype=int)
+        is_inlier[decision < 0] = -1
+        return is_inlier
+
+
+compiled_registry = ModelRegistry(MODEL_CACHE_SIZE, MODEL_MISSING_TTL, loader=CompiledForest.load, path_fn=compiled_path)
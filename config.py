@@ -1,3 +1,21 @@
 import os 
 
 OUTDOOR_TEMP_TAG = os.getenv("OUTDOOR_TEMP_TAG", "1473_04_AS01_VS01_GT300_PV")  # e.g., 1473_04_AS01_VS01_GT300_PV
+# Several outdoor sensors can be given comma-separated; tags are matched exactly
+OUTDOOR_TEMP_TAGS = frozenset(t.strip() for t in OUTDOOR_TEMP_TAG.split(",") if t.strip())
+OUTDOOR_TOLERANCE_SECONDS = float(os.getenv("OUTDOOR_TOLERANCE_SECONDS", 60))
+OUTDOOR_RETENTION_SECONDS = float(os.getenv("OUTDOOR_RETENTION_SECONDS", 7 * 24 * 3600))
+# Topics whose name contains this get the outdoor temperature merged in and used as a feature
+OUTDOOR_TOPIC_KEYWORD = os.getenv("OUTDOOR_TOPIC_KEYWORD", "heating").lower()
+# What to do with a realtime half pair whose partner has not arrived within PAIR_TTL_SECONDS:
+# drop it, score the single stream against its own running level (partner left empty), or
+# pair it with the partner's last known value
+LATE_PARTNER_POLICY = os.getenv("LATE_PARTNER_POLICY", "drop").lower()
+
+
+def subsystem_of(tag_name):
+    return "_".join(tag_name.split("_")[:3])
+
+
+def uses_outdoor(topic_name):
+    return bool(topic_name) and bool(OUTDOOR_TOPIC_KEYWORD) and OUTDOOR_TOPIC_KEYWORD in topic_name.lower()
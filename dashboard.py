@@ -7,6 +7,11 @@ import streamlit as st
 from PIL import Image
 import streamlit_authenticator as stauth
 import base64
+from storage import store_exists, read_generation
+from data_loader import topic_snapshot, DASHBOARD_TIMEZONE
+from metrics import read_stats_file, stage_summary, counter_total
+from history import HISTORY_ENABLED, anomaly_count, query_anomalies
+from charts import faceted_chart
 
 
 # Utility function to encode images to base64
@@ -116,13 +121,6 @@ else:
     username = st.session_state.get("username")
     # Proceed with the rest of your application
 
-@st.cache_data(ttl=0, show_spinner=False)
-def get_file_last_modified_time(file_path):
-    try:
-        return os.path.getmtime(file_path)
-    except FileNotFoundError:
-        return 0
-    
 # --- Streamlit UI setup ---
 st.title("Real-Time Anomaly Detection Dashboard")
 
@@ -150,36 +148,37 @@ subsystem = st.sidebar.selectbox("Select Subsystem", subsystems)
 st.sidebar.markdown("### Dashboard Controls")
 show_anomalies_only = st.sidebar.checkbox("Show Anomalous Sensors Only", value=False)
 enable_refresh = st.sidebar.checkbox("Auto-refresh", value=True)
+# Combined draws every sensor in one downsampled small-multiples chart, for subsystems with many sensors
+chart_layouts = ["Per sensor", "Combined"]
+default_layout = 1 if os.getenv("DASHBOARD_CHART_LAYOUT", "per-sensor").lower() == "combined" else 0
+chart_layout = st.sidebar.radio("Chart Layout", chart_layouts, index=default_layout)
 
 # Below you add rest of the side pane elements
 
-csv_path = f"{subsystem}.csv"
-
-if not os.path.exists(csv_path):
+if not store_exists(subsystem):
     st.warning(f"No data found for {subsystem}. Waiting for new data...")
     st.stop()
 
-from streamlit_autorefresh import st_autorefresh
-# File change detection
-last_mod_time = get_file_last_modified_time(csv_path)
-# Refresh only if the file has changed since last refresh
-if enable_refresh:
-    st_autorefresh(interval=2000, limit=1000, key=str(last_mod_time))
-
 try:
-    df = pd.read_csv(csv_path)
-    
+    # Shared by every session: only rows written since the last change are parsed
+    snapshot = topic_snapshot(subsystem)
 except Exception as e:
-    st.error(f"Failed to read {csv_path}: {e}")
+    st.error(f"Failed to read data for {subsystem}: {e}")
     st.stop()
 
-# --- Process Data ---
-df["Timestamp"] = pd.to_datetime(df["Timestamp"], errors="coerce")
-df["Timestamp"] = df["Timestamp"].dt.tz_convert("Europe/Stockholm") if df["Timestamp"].dt.tz else df["Timestamp"].dt.tz_localize("UTC").dt.tz_convert("Europe/Stockholm")
+df = snapshot.frame
+sensors = snapshot.sensors
+
+# Change detection: a fragment re-runs on its own every poll and only reads the store's
+# generation counter; the whole page reruns only once the writer has committed new rows
+REFRESH_POLL_SECONDS = float(os.getenv("DASHBOARD_POLL_SECONDS", 1))
 
-df = df.dropna(subset=["Sensor", "SetPoint", "Actual", "Timestamp"]).sort_values("Timestamp")
+@st.fragment(run_every=REFRESH_POLL_SECONDS if enable_refresh else None)
+def watch_generation(topic, seen):
+    if read_generation(topic) != seen:
+        st.rerun()
 
-sensors = sorted(df["Sensor"].unique())
+watch_generation(subsystem, snapshot.generation)
 
 st.sidebar.markdown("### Stats")
 st.sidebar.metric("Sensors Monitored", len(sensors))
@@ -188,25 +187,11 @@ if df.empty:
     st.info("No data available.")
     st.stop()
 
-# --- Visualize each sensor ---
-for sensor_id in sensors:
-    sensor_df = df[df["Sensor"] == sensor_id].tail(10)
-
-    if sensor_df.empty:
-        continue
-
-    latest_row = sensor_df.iloc[-1]
-    if show_anomalies_only and not latest_row.get("Anomaly", False):
-        continue
-
-    col1, col2, col3 = st.columns(3)
-    with col1:
-        st.metric("Latest SetPoint", f"{latest_row['SetPoint']:.2f}")
-    with col2:
-        st.metric("Latest Actual", f"{latest_row['Actual']:.2f}")
-    with col3:
-        st.metric("Anomaly Detected", "Yes" if latest_row.get("Anomaly", False) else "No")
-
+# Charts are rebuilt only for sensors that received rows since the last run, and shared
+# across sessions; `version` identifies the sensor's data, `_sensor_df` is not hashed
+@st.cache_resource(max_entries=1024)
+def sensor_chart(topic, sensor_id, version, _sensor_df):
+    sensor_df = _sensor_df
     y_min = sensor_df[["Actual", "SetPoint"]].min().min() - 2
     y_max = sensor_df[["Actual", "SetPoint"]].max().max() + 2
     y_scale = alt.Scale(domain=[y_min, y_max])
@@ -225,7 +210,7 @@ for sensor_id in sensors:
         strokeDash=alt.StrokeDash("Type:N")
     ).properties(width=800).interactive(bind_y=False)
 
-    line_chart = base.mark_line(interpolate='monotone').encode(
+    line_chart = base.mark_line(interpolate='monotone', invalid=None).encode(
         tooltip=[alt.Tooltip("Timestamp:T", title="Time", format="%H:%M"), "Value:Q", "Anomaly:O"]
     )
     points = base.mark_point(filled=True).encode(
@@ -246,18 +231,87 @@ for sensor_id in sensors:
     )
 
     chart = alt.layer(line_chart, points, anomaly_points)
-    chart = chart.configure_view(strokeWidth=0).configure(background='transparent')
+    return chart.configure_view(strokeWidth=0).configure(background='transparent')
+
+def format_value(value):
+    # Single-stream results have no partner value
+    return "–" if pd.isna(value) else f"{value:.2f}"
+
+# One spec per data generation and sensor selection, shared across sessions
+@st.cache_resource(max_entries=64)
+def subsystem_chart(topic, generation, selected, _frame):
+    return faceted_chart(_frame[_frame["Sensor"].isin(selected)])
+
+# --- Visualize each sensor ---
+if chart_layout == "Combined":
+    selected = tuple(
+        sensor_id for sensor_id in sensors
+        if not show_anomalies_only or snapshot.groups[sensor_id].iloc[-1].get("Anomaly", False)
+    )
+    if selected:
+        st.altair_chart(subsystem_chart(subsystem, snapshot.generation, selected, df), use_container_width=True)
+    else:
+        st.info("No anomalous sensors right now.")
+
+for sensor_id in (sensors if chart_layout == "Per sensor" else []):
+    sensor_df = snapshot.groups[sensor_id].tail(10)
+
+    if sensor_df.empty:
+        continue
+
+    latest_row = sensor_df.iloc[-1]
+    if show_anomalies_only and not latest_row.get("Anomaly", False):
+        continue
+
+    col1, col2, col3 = st.columns(3)
+    with col1:
+        st.metric("Latest SetPoint", format_value(latest_row['SetPoint']))
+    with col2:
+        st.metric("Latest Actual", format_value(latest_row['Actual']))
+    with col3:
+        st.metric("Anomaly Detected", "Yes" if latest_row.get("Anomaly", False) else "No")
 
     st.markdown(f"### Sensor: `{sensor_id}`")
-    st.altair_chart(chart, use_container_width=True)
+    st.altair_chart(sensor_chart(subsystem, sensor_id, snapshot.versions[sensor_id], sensor_df), use_container_width=True)
 
 # --- Historical Anomalies ---
-df_anomaly = df[df.get("Anomaly", False) == True].sort_values("Timestamp", ascending=False)
-st.sidebar.metric("Anomalies", len(df_anomaly))
+# Served from the long-term history index when it exists; the live file only holds the last few minutes
+ANOMALY_PAGE_SIZE = 20
+total_anomalies = anomaly_count(subsystem) if HISTORY_ENABLED else 0
+if total_anomalies:
+    st.sidebar.metric("Anomalies", total_anomalies)
+else:
+    df_anomaly = snapshot.anomalies
+    st.sidebar.metric("Anomalies", len(df_anomaly))
+
+# --- Pipeline stats written periodically by volga_consumer ---
+pipeline_stats = read_stats_file()
+if pipeline_stats:
+    with st.sidebar.expander("Pipeline Stats"):
+        st.metric("Messages Received", int(counter_total(pipeline_stats, "bms_messages_total")))
+        st.metric("Rows Written", int(counter_total(pipeline_stats, "bms_rows_written_total")))
+        st.metric("Anomalous Rows", int(counter_total(pipeline_stats, "bms_anomalies_total")))
+        stages = stage_summary(pipeline_stats)
+        if stages:
+            st.table(pd.DataFrame([
+                {"Stage": stage, "Calls": totals["count"], "Mean (ms)": round(1000 * totals["sum"] / totals["count"], 2)}
+                for stage, totals in sorted(stages.items()) if totals["count"]
+            ]))
 # Display logout button and user info in the sidebar
 st.markdown("## Historical Anomalies")
 
-if not df_anomaly.empty:
-    st.table(df_anomaly[["Timestamp", "Sensor", "SetPoint", "Actual", "Error"]].head(20))
+if total_anomalies:
+    history_sensors = st.multiselect("Filter by sensor", sensors, key="history_sensors")
+    pages = max(1, -(-total_anomalies // ANOMALY_PAGE_SIZE))
+    page = st.number_input(f"Page (of {pages} unfiltered)", min_value=1, max_value=pages, value=1, step=1)
+    df_anomaly = query_anomalies(subsystem, offset=(page - 1) * ANOMALY_PAGE_SIZE, limit=ANOMALY_PAGE_SIZE,
+                                 sensors=history_sensors or None)
+    df_anomaly["Timestamp"] = df_anomaly["Timestamp"].dt.tz_convert(DASHBOARD_TIMEZONE)
+    if not df_anomaly.empty:
+        st.table(df_anomaly)
+    else:
+        st.write("No anomalies on this page.")
+elif not df_anomaly.empty:
+    st.table(df_anomaly[["Timestamp", "Sensor", "SetPoint", "Actual", "Error"]].head(ANOMALY_PAGE_SIZE))
 else:
     st.write("No anomalies recorded yet.")
\ No newline at end of file
@@ -0,0 +1,83 @@
+import os
+import threading
+import pandas as pd
+
+from storage import ring_path, csv_path, read_generation, read_ring_since, records_to_frame
+
+DASHBOARD_TIMEZONE = os.getenv("DASHBOARD_TIMEZONE", "Europe/Stockholm")
+
+
+class TopicSnapshot:
+    # Read-only view of a topic shared by every dashboard session; callers must not mutate it
+    def __init__(self, generation, frame):
+        self.generation = generation
+        self.frame = frame
+        self.groups = {sensor: group for sensor, group in frame.groupby("Sensor", sort=True)}
+        self.sensors = list(self.groups)
+        # Changes whenever a sensor gets new rows, so per-sensor work can be cached on it
+        self.versions = {sensor: (len(group), group["Timestamp"].iat[-1].value) for sensor, group in self.groups.items()}
+        if "Anomaly" in frame:
+            self.anomalies = frame[frame["Anomaly"] == True].sort_values("Timestamp", ascending=False)
+        else:
+            self.anomalies = frame.iloc[:0]
+
+
+def _prepare(df):
+    # Display timezone, drop unusable rows; done once per new row instead of per session.
+    # A single-stream result (late partner policy) keeps the value it has; charts show the gap.
+    df["Timestamp"] = pd.to_datetime(df["Timestamp"], errors="coerce", utc=True).dt.tz_convert(DASHBOARD_TIMEZONE)
+    df = df.dropna(subset=["Sensor", "Timestamp"])
+    return df.dropna(subset=["SetPoint", "Actual"], how="all")
+
+
+class TopicLoader:
+    # Follows one topic's live store. A reload happens only when the store's generation
+    # changes, and for ring stores only the records appended since the last load are
+    # converted; CSV stores are rewritten whole, so they are re-read whole.
+    def __init__(self, topic_name):
+        self.topic_name = topic_name
+        self.snapshot = None
+        self.rows = None  # ring rows in write order, newest last
+        self.total = 0
+        self._lock = threading.Lock()
+
+    def load(self):
+        generation = read_generation(self.topic_name)
+        snapshot = self.snapshot
+        if snapshot is not None and snapshot.generation == generation:
+            return snapshot
+        with self._lock:
+            # Another session may have refreshed while this one waited
+            if self.snapshot is not None and self.snapshot.generation == generation:
+                return self.snapshot
+            self.snapshot = TopicSnapshot(generation, self._read())
+            return self.snapshot
+
+    def _read(self):
+        path = ring_path(self.topic_name)
+        if not os.path.exists(path):
+            self.rows, self.total = None, 0
+            return _prepare(pd.read_csv(csv_path(self.topic_name))).sort_values("Timestamp", kind="stable")
+        records, total, capacity = read_ring_since(path, self.total)
+        fresh = _prepare(records_to_frame(records))
+        if self.rows is None or total - self.total != len(records):
+            # First load, or the ring wrapped or was recreated since: start over
+            self.rows = fresh
+        elif len(fresh):
+            # The ring holds at most `capacity` rows, so older ones have been overwritten
+            self.rows = pd.concat([self.rows, fresh], ignore_index=True).tail(capacity)
+        self.total = total
+        return self.rows.sort_values("Timestamp", kind="stable").reset_index(drop=True)
+
+
+_loaders = {}
+_loaders_lock = threading.Lock()
+
+
+def topic_snapshot(topic_name):
+    # Process-wide: every Streamlit session in this server shares the same loader
+    with _loaders_lock:
+        loader = _loaders.get(topic_name)
+        if loader is None:
+            loader = _loaders[topic_name] = TopicLoader(topic_name)
+    return loader.load()
@@ -6,6 +6,14 @@ from sklearn.ensemble import IsolationForest
 from sklearn.svm import OneClassSVM
 from sklearn.preprocessing import StandardScaler
 import joblib
+from model_registry import model_registry, model_path
+from compiled_forest import CompiledForest, ISF_COMPILED, compiled_registry, compiled_path
+from metrics import timed, anomalies_total
+from zscore import zscore_tracker, ZSCORE_GATE
+from results import DetectionResult
+from storage import atomic_write
+from features import FEATURE_SCHEMA_VERSION, SETPOINT, ACTUAL, ERROR, build_feature_matrix, build_feature_batch, feature_frame, feature_schema
+from config import LATE_PARTNER_POLICY
 
 
 logger = setup_logger(__name__)
@@ -16,72 +24,296 @@ from sklearn.ensemble import IsolationForest
 ANOMALY_STD_MULTIPLIER = float(os.getenv("ANOMALY_STD_MULTIPLIER", 3))
 ISF_CONTAMINATION = float(os.getenv("ISF_CONTAMINATION", 0.05))
 ISF_RANDOM_STATE = int(os.getenv("ISF_RANDOM_STATE", 42))
+ISF_N_JOBS = int(os.getenv("ISF_N_JOBS", 1))
 
-def train_model_for_sensor(df: pd.DataFrame, sp_tag: str, pv_tag: str, topic_name: str):
-    sp_col = f"SetPoint_{sp_tag}"
-    pv_col = f"Actual_{pv_tag}"
-    err_col = f"Error_{sp_tag}"
+def sensor_prefix(sp_tag: str) -> str:
+    return sp_tag.rsplit("_", 1)[0]
 
-    df[err_col] = df[sp_col] - df[pv_col]
 
-    df["Hour"] = df["Timestamp"].dt.hour
-    df["DayOfWeek"] = df["Timestamp"].dt.dayofweek
-    df["IsWeekend"] = df["DayOfWeek"].isin([5, 6]).astype(int)
+def build_features(df: pd.DataFrame, sp_tag: str, pv_tag: str, topic_name: str):
+    # Feature matrix and names; the error column is also kept on the frame for the result row
+    X, names = build_feature_matrix(df, sp_tag, pv_tag, topic_name)
+    df[names[ERROR]] = X[:, ERROR]
+    return X, names
 
-    feature_cols = [sp_col, pv_col, err_col, "Hour", "DayOfWeek", "IsWeekend"]
-    # Add Outdoor_Temperature only for heating topics and if present in columns
-    if topic_name and "heating" in topic_name.lower() and "Outdoor_Temperature" in df.columns:
-        feature_cols.append("Outdoor_Temperature")
-    df_train = df[feature_cols].dropna()
 
-    if df_train.empty:
-        logger.info(f"No training data for sensor {sp_tag}, skipping.")
-        return
+def _schema_ok(model, sp_tag: str, registry) -> bool:
+    schema = feature_schema(model)
+    if schema == FEATURE_SCHEMA_VERSION:
+        return True
+    logger.warning("Model for %s uses feature schema %s, expected %s; retrain it. Skipping.",
+                   sp_tag, schema, FEATURE_SCHEMA_VERSION)
+    registry.mark_missing(sp_tag)
+    return False
 
-    model = IsolationForest(contamination=ISF_CONTAMINATION, random_state=ISF_RANDOM_STATE)
-    model.fit(df_train)
 
-    model_filename = f"{sp_tag}_model.joblib"
-    joblib.dump(model, model_filename)
-    logger.info(f"Model trained and saved for {sp_tag} at {model_filename}")
+def get_model(sp_tag: str):
+    # Prefer the flattened forest for scoring; fall back to the pickled IsolationForest
+    if ISF_COMPILED:
+        try:
+            scorer = compiled_registry.get(sp_tag)
+        except (OSError, ValueError, KeyError) as e:
+            logger.warning("Could not load compiled forest for %s: %s", sp_tag, e)
+            compiled_registry.mark_missing(sp_tag)
+            scorer = None
+        if scorer is not None and _schema_ok(scorer, sp_tag, compiled_registry):
+            return scorer
+    model = model_registry.get(sp_tag)
+    if model is not None and not _schema_ok(model, sp_tag, model_registry):
+        return None
+    return model
 
 
-def detect_anomalies_isolation_forest(df: pd.DataFrame, sp_tag: str, pv_tag: str, topic_name: str):
+def stream_key(tag: str) -> str:
+    # z-score state of a stream's own values, next to the sp_tag-keyed control error state
+    return f"{tag}:value"
 
-    sp_col = f"SetPoint_{sp_tag}"
-    pv_col = f"Actual_{pv_tag}"
-    err_col = f"Error_{sp_tag}"
-    anomaly_col = f"Anomaly_{sp_tag}"
 
-    df[err_col] = df[sp_col] - df[pv_col]
-    df["Hour"] = df["Timestamp"].dt.hour
-    df["DayOfWeek"] = df["Timestamp"].dt.dayofweek
-    df["IsWeekend"] = df["DayOfWeek"].isin([5, 6]).astype(int)
+def gate_keys(prefix: str):
+    # Every z-score state realtime scoring of a pair can read or update
+    sp_tag, pv_tag = f"{prefix}_CSP", f"{prefix}_PV"
+    return [sp_tag, stream_key(sp_tag), stream_key(pv_tag)]
+
+
+def score_single_stream(X: np.ndarray, sp_tag: str, pv_tag: str):
+    # Late partner policy "single". Every pair keeps a running level per stream; a pair whose
+    # partner never arrived has no control error, so its present stream is flagged where it
+    # lies more than ANOMALY_STD_MULTIPLIER deviations from that level. None for full pairs.
+    if LATE_PARTNER_POLICY != "single":
+        return None
+    flags = None
+    single = np.isnan(X[:, ERROR]).all()
+    for tag, column in ((sp_tag, SETPOINT), (pv_tag, ACTUAL)):
+        values = X[:, column]
+        present = ~np.isnan(values)
+        if not present.any():
+            continue
+        z, warm = zscore_tracker.update(stream_key(tag), values[present])
+        if single:
+            flags = np.zeros(len(X), dtype=bool)
+            flags[present] = warm & (np.abs(z) > ANOMALY_STD_MULTIPLIER)
+    zscore_tracker.maybe_save()
+    return flags
+
+
+def rows_for_model(errors: np.ndarray, sp_tag: str) -> np.ndarray:
+    # Positions of the rows the IsolationForest still has to score once the z-score tier has seen them
+    rows = np.flatnonzero(~np.isnan(errors))
+    if not ZSCORE_GATE or not len(rows):
+        return rows
+    send = zscore_tracker.gate(sp_tag, errors[rows])
+    zscore_tracker.maybe_save()
+    return rows[send]
 
-    feature_cols = [sp_col, pv_col, err_col, "Hour", "DayOfWeek", "IsWeekend"]
-    if topic_name and "heating" in topic_name.lower() and "Outdoor_Temperature" in df.columns:
-        feature_cols.append("Outdoor_Temperature")
-    df_predict = df[feature_cols].dropna()
 
+def model_features(model, names):
+    # Feature matrix columns in the order the model was fitted on. A model trained with or
+    # without the outdoor feature keeps working when the outdoor signal comes or goes;
+    # None if the matrix lacks something the model needs.
+    model_names = getattr(model, "feature_names_in_", None)
+    if model_names is None:
+        return list(range(len(names))) if getattr(model, "n_features_in_", len(names)) == len(names) else None
     try:
-        model_path = f"{sp_tag}_model.joblib"
-        model = joblib.load(model_path)
+        return [names.index(name) for name in model_names]
+    except ValueError:
+        return None
+
+
+def complete_rows(X: np.ndarray, names, rows: np.ndarray, columns):
+    # The rows among `rows` with every model feature present, their features and names
+    X_predict = X[np.ix_(rows, columns)]
+    complete = ~np.isnan(X_predict).any(axis=1)
+    if not complete.all():
+        rows, X_predict = rows[complete], X_predict[complete]
+    return rows, X_predict, [names[i] for i in columns]
+
+
+def _column_value(df: pd.DataFrame, column: str, row: int) -> float:
+    return float(df[column].iat[row]) if column in df.columns else np.nan
+
+
+def latest_result(df: pd.DataFrame, sp_tag: str, pv_tag: str):
+    # The newest row of a scored pair as a DetectionResult, None for an empty frame
+    timestamps = df["Timestamp"].array.asi8
+    if not len(timestamps):
+        return None
+    row = int(np.argmax(timestamps))  # first of the rows at the newest timestamp
+    anomaly_col = f"Anomaly_{sp_tag}"
+    return DetectionResult(
+        int(timestamps[row]),
+        sensor_prefix(sp_tag),
+        _column_value(df, f"SetPoint_{sp_tag}", row),
+        _column_value(df, f"Actual_{pv_tag}", row),
+        _column_value(df, f"Error_{sp_tag}", row),
+        bool(df[anomaly_col].iat[row]) if anomaly_col in df.columns else False,
+        _column_value(df, "Outdoor_Temperature", row),
+    )
+
+
+def _discard_compiled(sp_tag: str):
+    # get_model prefers the compiled forest, so one left over from an earlier training
+    # would keep being served instead of the model trained now
+    try:
+        os.remove(compiled_path(sp_tag))
     except FileNotFoundError:
-        logger.warning(f"Model not found for {sp_tag}, skipping anomaly detection.")
-        df[anomaly_col] = False
+        pass
+    except OSError as e:
+        logger.warning("Could not remove stale compiled forest for %s: %s", sp_tag, e)
+    compiled_registry.invalidate(sp_tag)
+
+
+def train_model_for_sensor(df: pd.DataFrame, sp_tag: str, pv_tag: str, topic_name: str):
+    X, names = build_feature_matrix(df, sp_tag, pv_tag, topic_name)
+    X = X[~np.isnan(X).any(axis=1)]
+
+    if not len(X):
+        logger.info("No training data for sensor %s, skipping.", sp_tag)
+        return
+    df_train = feature_frame(X, names)
+
+    model = IsolationForest(contamination=ISF_CONTAMINATION, random_state=ISF_RANDOM_STATE, n_jobs=ISF_N_JOBS)
+    with timed("train", topic_name, sensor_prefix(sp_tag)):
+        model.fit(df_train)
+    model.feature_schema_ = FEATURE_SCHEMA_VERSION
+
+    exported = False
+    if ISF_COMPILED:
+        try:
+            compiled = CompiledForest.from_sklearn(model)
+            compiled.save(compiled_path(sp_tag))
+            compiled_registry.put(sp_tag, compiled)
+            exported = True
+        except Exception as e:
+            logger.warning("Could not export compiled forest for %s: %s", sp_tag, e)
+    if not exported:
+        _discard_compiled(sp_tag)
+
+    model_filename = model_path(sp_tag)
+    with atomic_write(model_filename) as f:
+        joblib.dump(model, f)
+    model_registry.put(sp_tag, model)
+    logger.info("Model trained and saved for %s at %s", sp_tag, model_filename)
+
+
+def _single_stream_result(df: pd.DataFrame, sp_tag: str, topic_name: str, flags: np.ndarray):
+    df[f"Anomaly_{sp_tag}"] = flags
+    anomalies_total.inc(int(flags.sum()), topic=topic_name, prefix=sensor_prefix(sp_tag))
+    logger.info("Anomalies (single stream z-score) detected for %s: %s rows", sp_tag, flags.sum())
+    return df, bool(flags.any())
+
+
+def detect_anomalies_isolation_forest(df: pd.DataFrame, sp_tag: str, pv_tag: str, topic_name: str):
+    anomaly_col = f"Anomaly_{sp_tag}"
+
+    X, names = build_features(df, sp_tag, pv_tag, topic_name)
+    df[anomaly_col] = False
+
+    single = score_single_stream(X, sp_tag, pv_tag)
+    if single is not None:
+        return _single_stream_result(df, sp_tag, topic_name, single)
+
+    rows = rows_for_model(X[:, ERROR], sp_tag)
+    if not len(rows):
+        # Nothing the z-score tier wants checked
+        return df, False
+
+    model = get_model(sp_tag)
+    if model is None:
+        logger.warning("Model not found for %s, skipping anomaly detection.", sp_tag)
         return df, False
 
-    preds = model.predict(df_predict)
+    columns = model_features(model, names)
+    if columns is None:
+        logger.warning("Features for %s do not match its model, skipping anomaly detection.", sp_tag)
+        return df, False
+    rows, X_predict, predict_names = complete_rows(X, names, rows, columns)
+    if not len(rows):
+        return df, False
+
+    with timed("predict", topic_name, sensor_prefix(sp_tag)):
+        preds = model.predict(feature_frame(X_predict, predict_names))
     anomaly_flags = (preds == -1)
+    anomalies_total.inc(int(anomaly_flags.sum()), topic=topic_name, prefix=sensor_prefix(sp_tag))
 
     # Align predictions with original DataFrame
-    df[anomaly_col] = False
-    df.loc[df_predict.index, anomaly_col] = anomaly_flags
+    anomalies = np.zeros(len(df), dtype=bool)
+    anomalies[rows] = anomaly_flags
+    df[anomaly_col] = anomalies
 
-    logger.info(f"Anomalies (Isolation Forest) detected for {sp_tag}: {anomaly_flags.sum()} rows")
+    logger.info("Anomalies (Isolation Forest) detected for %s: %s rows", sp_tag, anomaly_flags.sum())
     return df, anomaly_flags.any()
 
+
+# Score several sensor pairs in one pass: the features of the whole batch are built as one
+# stacked matrix, then its rows are split by sensor so every model gets a single predict
+# call, however many pairs it owns.
+def detect_anomalies_batch(items):
+    # items: list of (df, sp_tag, pv_tag, topic_name)
+    results = [None] * len(items)
+    if not items:
+        return results
+
+    stacked_X, offsets, batch_names = build_feature_batch(items)
+    by_model = {}
+    matrices = [None] * len(items)
+    for i, (df, sp_tag, pv_tag, topic_name) in enumerate(items):
+        names = batch_names[i]
+        X = stacked_X[offsets[i]:offsets[i + 1], :len(names)]
+        df[names[ERROR]] = X[:, ERROR]
+        matrices[i] = (X, names)
+        df[f"Anomaly_{sp_tag}"] = False
+        results[i] = (df, False)
+        single = score_single_stream(X, sp_tag, pv_tag)
+        if single is not None:
+            results[i] = _single_stream_result(df, sp_tag, topic_name, single)
+            continue
+        rows = rows_for_model(X[:, ERROR], sp_tag)
+        if len(rows):
+            by_model.setdefault(sp_tag, []).append((i, rows))
+
+    for sp_tag, pending in by_model.items():
+        model = get_model(sp_tag)
+        if model is None:
+            logger.warning("Model not found for %s, skipping anomaly detection.", sp_tag)
+            continue
+
+        entries = []
+        predict_names = None
+        for i, rows in pending:
+            X, names = matrices[i]
+            columns = model_features(model, names)
+            if columns is None:
+                logger.warning("Features for %s do not match its model, skipping anomaly detection.", sp_tag)
+                continue
+            rows, X_predict, predict_names = complete_rows(X, names, rows, columns)
+            entries.append((i, rows, X_predict))
+        if not entries:
+            continue
+
+        stacked = np.concatenate([X_predict for _, _, X_predict in entries]) if len(entries) > 1 else entries[0][2]
+        if not len(stacked):
+            continue
+        topic_name = items[entries[0][0]][3]
+        with timed("predict", topic_name, sensor_prefix(sp_tag)):
+            anomaly_flags = model.predict(feature_frame(stacked, predict_names)) == -1
+        anomalies_total.inc(int(anomaly_flags.sum()), topic=topic_name, prefix=sensor_prefix(sp_tag))
+
+        start = 0
+        for i, rows, _ in entries:
+            flags = anomaly_flags[start:start + len(rows)]
+            start += len(rows)
+            df = results[i][0]
+            anomalies = np.zeros(len(df), dtype=bool)
+            anomalies[rows] = flags
+            df[f"Anomaly_{sp_tag}"] = anomalies
+            results[i] = (df, bool(flags.any()))
+
+        logger.info("Anomalies (Isolation Forest, batched x%s) detected for %s: %s rows", len(entries), sp_tag, anomaly_flags.sum())
+
+    return results
+
 # Anomaly detection using Z-Score method 
+# Standalone streaming z-score detector; shares its per-sensor state with the gate
 def detect_anomalies_for_pair(df: pd.DataFrame, sp_tag: str, pv_tag: str) -> pd.DataFrame:
     sp_col = f"SetPoint_{sp_tag}"
     pv_col = f"Actual_{pv_tag}"
@@ -89,16 +321,16 @@ def detect_anomalies_for_pair(df: pd.DataFrame, sp_tag: str, pv_tag: str) -> pd.
     anomaly_col = f"Anomaly_{sp_tag}"
 
     if sp_col not in df.columns or pv_col not in df.columns:
-        logger.warning(f"Missing required columns: {sp_col}, {pv_col}")
+        logger.warning("Missing required columns: %s, %s", sp_col, pv_col)
         return df
 
     df[err_col] = df[sp_col] - df[pv_col]
+    df[anomaly_col] = False
 
-    mean = df[err_col].mean()
-    std = df[err_col].std()
-    threshold = ANOMALY_STD_MULTIPLIER * std
-
-    df[anomaly_col] = np.abs(df[err_col] - mean) > threshold
-    logger.info(f"Anomalies (Z-Score) detected for {sp_tag}: {df[anomaly_col].sum()} rows")
+    rows = df.index[df[err_col].notna()]
+    z, warm = zscore_tracker.update(sp_tag, df.loc[rows, err_col].to_numpy())
+    df.loc[rows, anomaly_col] = warm & (np.abs(z) > ANOMALY_STD_MULTIPLIER)
+    zscore_tracker.maybe_save()
+    logger.info("Anomalies (Z-Score) detected for %s: %s rows", sp_tag, df[anomaly_col].sum())
 
-    return df, df[anomaly_col].any()
\ No newline at end of file
+    return df, df[anomaly_col].any()
@@ -0,0 +1,79 @@
+import numpy as np
+import pandas as pd
+
+from config import uses_outdoor
+
+# Bump whenever a feature is added, removed, reordered or computed differently; models
+# carry the version they were trained with and are refused when it differs
+FEATURE_SCHEMA_VERSION = 1
+
+OUTDOOR_FEATURE = "Outdoor_Temperature"
+SETPOINT, ACTUAL, ERROR, HOUR, DAY_OF_WEEK, IS_WEEKEND, OUTDOOR = range(7)
+
+HOUR_NS = 3600 * 1_000_000_000
+EPOCH_DAY_OF_WEEK = 3  # 1970-01-01 was a Thursday
+
+
+def feature_names(sp_tag, pv_tag, outdoor=False):
+    names = [f"SetPoint_{sp_tag}", f"Actual_{pv_tag}", f"Error_{sp_tag}", "Hour", "DayOfWeek", "IsWeekend"]
+    if outdoor:
+        names.append(OUTDOOR_FEATURE)
+    return names
+
+
+def timestamps_ns(df):
+    return df["Timestamp"].array.as_unit("ns").asi8
+
+
+def calendar_features(timestamps, out):
+    # Hour, day of week and weekend flag (UTC) straight from the hour bucket of each
+    # epoch-ns timestamp, written into the three columns of `out`
+    hours = timestamps // HOUR_NS
+    days = hours // 24
+    out[:, 0] = hours - days * 24
+    day_of_week = (days + EPOCH_DAY_OF_WEEK) % 7
+    out[:, 1] = day_of_week
+    out[:, 2] = day_of_week >= 5
+    return out
+
+
+def build_feature_matrix(df, sp_tag, pv_tag, topic_name):
+    # All model features of a merged pair in one float64 array, columns in feature_names()
+    # order. Outdoor temperature is included for outdoor topics that have it.
+    X, _, names = build_feature_batch([(df, sp_tag, pv_tag, topic_name)])
+    return X[:, :len(names[0])], names[0]
+
+
+def build_feature_batch(items):
+    # items: list of (df, sp_tag, pv_tag, topic_name). Every pair's rows stacked into one
+    # preallocated array, so the error and calendar columns are computed once for the
+    # whole batch. Returns the array, the row offsets of the pairs (n + 1) and each pair's
+    # names; rows offsets[i]:offsets[i + 1], first len(names[i]) columns, are pair i's
+    # features. The outdoor column is NaN for pairs without it.
+    offsets = np.zeros(len(items) + 1, dtype=np.int64)
+    np.cumsum([len(df) for df, _, _, _ in items], out=offsets[1:])
+    X = np.empty((offsets[-1], OUTDOOR + 1))
+    X[:, OUTDOOR] = np.nan
+    names = []
+    for (df, sp_tag, pv_tag, topic_name), start, end in zip(items, offsets[:-1], offsets[1:]):
+        outdoor = uses_outdoor(topic_name) and OUTDOOR_FEATURE in df.columns
+        pair_names = feature_names(sp_tag, pv_tag, outdoor)
+        X[start:end, SETPOINT] = df[pair_names[SETPOINT]].to_numpy(dtype=np.float64)
+        X[start:end, ACTUAL] = df[pair_names[ACTUAL]].to_numpy(dtype=np.float64)
+        if outdoor:
+            X[start:end, OUTDOOR] = df[OUTDOOR_FEATURE].to_numpy(dtype=np.float64)
+        names.append(pair_names)
+    np.subtract(X[:, SETPOINT], X[:, ACTUAL], out=X[:, ERROR])
+    timestamps = [timestamps_ns(df) for df, _, _, _ in items]
+    calendar_features(np.concatenate(timestamps) if len(timestamps) > 1 else timestamps[0], X[:, HOUR:IS_WEEKEND + 1])
+    return X, offsets, names
+
+
+def feature_frame(X, names):
+    # sklearn models were fitted on named columns and expect them back
+    return pd.DataFrame(X, columns=names, copy=False)
+
+
+def feature_schema(model):
+    # Artifacts from before the schema was versioned used exactly the version 1 layout
+    return int(getattr(model, "feature_schema_", 1))
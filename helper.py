@@ -1,51 +1,247 @@
 from logger_config import setup_logger
+import os
+import re
+import time
+import itertools
+import numpy as np
 import pandas as pd
 from datetime import datetime
 from collections import defaultdict
 from preprocess_data import try_merge_and_detect
-from config import OUTDOOR_TEMP_TAG
+from pair_buffer import PairBuffer, RingPair, WindowPair, pair_evictions_total
+from config import OUTDOOR_TEMP_TAGS, LATE_PARTNER_POLICY, subsystem_of
+from reference_store import reference_store, outdoor_window
+from metrics import registry as metrics_registry, timed, pairs_total, buffered_pairs
 
-# Buffer to temporarily store data until both CSP and PV arrive
-payload_buffer = defaultdict(dict)
-outdoor_buffer = {}
+# Seconds to gather completed realtime pairs before scoring them together (0 disables batching)
+SCORING_BATCH_WINDOW = float(os.getenv("SCORING_BATCH_WINDOW", 0))
+# Layout of payload timestamps; ISO8601 takes a NumPy fast path when all keys share one width and offset
+TIMESTAMP_FORMAT = os.getenv("TIMESTAMP_FORMAT", "ISO8601")
+# Points parsed per chunk when converting large (historical) payloads
+PARSE_CHUNK_POINTS = int(os.getenv("PARSE_CHUNK_POINTS", 50000))
+# Minimum seconds between expiry sweeps of a topic's buffered pairs
+PAIR_SWEEP_INTERVAL = float(os.getenv("PAIR_SWEEP_INTERVAL", 10))
+
+# Realtime buffers to temporarily store data until both CSP and PV arrive
+payload_buffer = PairBuffer(RingPair, "realtime")
+historical_buffer = PairBuffer(WindowPair, "historical")
+last_sweep = {}
+
+# Completed realtime pairs waiting for the next batched scoring pass, per topic
+pending_pairs = defaultdict(list)
+pending_since = {}
+
+partial_pairs_total = metrics_registry.counter(
+    "bms_partial_pairs_total", "Realtime half pairs resolved by the late partner policy", ["policy"]
+)
 
 logger = setup_logger(__name__)
 
 
-def parse_and_store_payload(topic, payload, mode):
+def _collect_buffered_pairs():
+    buffered_pairs.set(payload_buffer.half_complete() + historical_buffer.half_complete())
+    payload_buffer.collect()
+    historical_buffer.collect()
+
+
+metrics_registry.add_collector(_collect_buffered_pairs)
+
+
+_ISO_LAYOUT = re.compile(r"^\d{4}-\d\d-\d\d[T ]\d\d:\d\d(?::\d\d(?:\.\d{1,9})?)?(Z|[+-]\d\d:\d\d)?$")
+
+
+def _offset_ns(suffix):
+    if not suffix or suffix == "Z":
+        return 0
+    sign = -1 if suffix[0] == "-" else 1
+    return sign * (int(suffix[1:3]) * 3600 + int(suffix[4:6]) * 60) * 1_000_000_000
+
+
+def _parse_uniform_iso(keys):
+    # Fast path for the common upload shape: every key has the same width and UTC offset,
+    # so the offset can be cut off and NumPy's own ISO parser does the rest
+    match = _ISO_LAYOUT.match(keys[0])
+    if match is None:
+        return None
+    suffix = match.group(1) or ""
+    width = len(keys[0])
+    arr = np.array(keys)
+    if arr.dtype.itemsize // 4 != width or not (np.char.str_len(arr) == width).all():
+        return None
+    if suffix and not np.char.endswith(arr, suffix).all():
+        return None
+    try:
+        parsed = arr.astype(f"U{width - len(suffix)}").astype("datetime64[ns]")
+    except ValueError:
+        return None
+    if np.isnat(parsed).any():
+        return None
+    return parsed.view(np.int64) - _offset_ns(suffix)
+
+
+def parse_timestamps(keys):
+    # Timestamp strings -> int64 epoch ns in UTC
+    if TIMESTAMP_FORMAT == "ISO8601":
+        timestamps = _parse_uniform_iso(keys)
+        if timestamps is not None:
+            return timestamps
+    try:
+        return pd.to_datetime(keys, utc=True, format=TIMESTAMP_FORMAT).as_unit("ns").asi8
+    except ValueError:
+        logger.warning("Timestamps do not match TIMESTAMP_FORMAT=%s, inferring per value", TIMESTAMP_FORMAT)
+        return pd.to_datetime(keys, utc=True, format="mixed").as_unit("ns").asi8
+
+
+def parse_values(values, count):
+    try:
+        return np.fromiter(values, dtype=np.float64, count=count).astype(np.float32)
+    except (TypeError, ValueError):
+        # None or numeric strings in the payload
+        return np.array(list(values), dtype=np.float64).astype(np.float32)
+
+
+def parse_series(time_series, chunk_points=PARSE_CHUNK_POINTS):
+    # {timestamp: value} -> (int64 epoch ns in UTC, float32 values), built straight into
+    # preallocated arrays. Large historical windows are parsed chunk by chunk so only one
+    # chunk of intermediate strings is alive at a time.
+    n = len(time_series)
+    values = parse_values(time_series.values(), n)
+    timestamps = np.empty(n, dtype=np.int64)
+    keys = iter(time_series)
+    for start in range(0, n, chunk_points):
+        chunk = list(itertools.islice(keys, chunk_points))
+        timestamps[start:start + len(chunk)] = parse_timestamps(chunk)
+    return timestamps, values
+
+
+def _detach(series):
+    return tuple(a.copy() for a in series)
+
+
+# Buffer a payload and return a (sp, pv, prefix, mode, topic, outdoor) job once its pair is complete.
+# Jobs that outlive the call (executor, batching) need copy=True to detach them from the ring storage.
+def store_payload(topic, payload, mode, copy=False):
+    tag_name = list(payload.keys())[0]
+    with timed("ingest", topic, tag_name.rsplit('_', 1)[0]):
+        job = _store_payload(topic, payload, mode, copy)
+    if job is not None:
+        pairs_total.inc(topic=topic, mode=mode)
+    return job
+
+
+def _store_payload(topic, payload, mode, copy):
     tag_name = list(payload.keys())[0]
     time_series = payload[tag_name]
     prefix = tag_name.rsplit('_', 1)[0]
-    subsystem = "_".join(tag_name.split("_")[:3])
+    subsystem = subsystem_of(tag_name)
+
+    logger.info("Mode: %s, Topic: %s, Received payload for tag: %s with %s entries.", mode, topic, tag_name, len(time_series))
+
+    series = parse_series(time_series)
+
+    if tag_name in OUTDOOR_TEMP_TAGS:
+        logger.info("Detected outdoor temperature sensor: %s", tag_name)
+        reference_store.add(tag_name, *series)
+        return None
+
+    side = "CSP" if tag_name.endswith("_CSP") else "PV" if tag_name.endswith("_PV") else None
+    if side is None:
+        logger.info("Ignoring tag without a _CSP/_PV suffix: %s", tag_name)
+        return None
+
+    if mode == "historical":
+        entry = historical_buffer.add(prefix, topic, subsystem, side, series)
+        if entry.ready():
+            logger.info("Pair found for tag prefix: %s. Proceeding to merge and train.", prefix)
+            sp, pv = historical_buffer.take(prefix)
+            historical_buffer.pop(prefix)
+            return (sp, pv, prefix, mode, topic, outdoor_window(subsystem, sp[0]))
+        return None
+
+    entry = payload_buffer.add(prefix, topic, subsystem, side, series)
+    if entry.ready():
+        logger.info("Pair found for tag prefix: %s. Proceeding to merge and detect.", prefix)
+        sp, pv = payload_buffer.take(prefix)
+        if copy:
+            sp, pv = _detach(sp), _detach(pv)
+        return (sp, pv, prefix, mode, topic, outdoor_window(subsystem, sp[0]))
+    return None
+
+
+def _late_partner_job(prefix, entry, policy):
+    # The waiting stream keeps its own timestamps; the missing partner becomes NaN
+    # ("single") or the partner's last known value carried forward ("last")
+    present, missing = (entry.csp, entry.pv) if entry.csp.unread else (entry.pv, entry.csp)
+    ts, values = _detach(present.take_unread())
+    entry.pending_since = None
+    if policy == "last":
+        last = missing.last()
+        if last is None:
+            return None
+        filler = np.full(len(ts), last[1], dtype=np.float32)
+    elif policy == "single":
+        filler = np.full(len(ts), np.nan, dtype=np.float32)
+    else:
+        return None
+    partner = (ts.copy(), filler)
+    sp, pv = ((ts, values), partner) if present is entry.csp else (partner, (ts, values))
+    return (sp, pv, prefix, "realtime", entry.topic, outdoor_window(entry.subsystem, ts))
+
+
+# Expire half-complete pairs and idle prefixes of `topic`; returns jobs produced by the late partner policy
+def expire_pairs(topic, policy=LATE_PARTNER_POLICY, force=False):
+    now = time.monotonic()
+    if not force and now - last_sweep.get(topic, 0) < PAIR_SWEEP_INTERVAL:
+        return []
+    last_sweep[topic] = now
+
+    jobs = []
+    for prefix, entry in payload_buffer.expired(topic, now):
+        job = _late_partner_job(prefix, entry, policy)
+        partial_pairs_total.inc(policy=policy if job is not None else "drop")
+        pair_evictions_total.inc(reason="ttl", mode="realtime")
+        if job is None:
+            logger.info("Dropping half pair for %s after %ss without a partner", prefix, payload_buffer.ttl)
+        else:
+            jobs.append(job)
+    for prefix, entry in historical_buffer.expired(topic, now):
+        logger.info("Dropping historical half pair for %s after %ss without a partner", prefix, historical_buffer.ttl)
+        historical_buffer.pop(prefix, "ttl")
+
+    payload_buffer.drop_idle(topic, now)
+    historical_buffer.drop_idle(topic, now)
+    return jobs
+
+
+def run_pair_job(job):
+    sp, pv, prefix, mode, topic, outdoor = job
+    return try_merge_and_detect(sp, pv, prefix, mode, topic, outdoor=outdoor)
 
-    logger.info(f"Mode: {mode}, Topic: {topic}, Received payload for tag: {tag_name} with {len(time_series)} entries.")
 
-    df = pd.DataFrame(time_series.items(), columns=["Timestamp", "Value"])
-    df["Timestamp"] = pd.to_datetime(df["Timestamp"])
-    df.set_index("Timestamp", inplace=True)
+def queue_for_scoring(job):
+    sp, pv, prefix, mode, topic, outdoor = job
+    if not pending_pairs[topic]:
+        pending_since[topic] = time.monotonic()
+    pending_pairs[topic].append((sp, pv, prefix, topic, outdoor))
 
-    logger.info(f"Converted payload to DataFrame with shape: {df.shape}")
 
-    if tag_name in OUTDOOR_TEMP_TAG:
-        logger.info(f"Detected outdoor temperature sensor: {tag_name}")
-        outdoor_buffer[subsystem] = df
-        return
-    elif tag_name.endswith("_CSP"):
-        payload_buffer[prefix]["CSP"] = df
-    elif tag_name.endswith("_PV"):
-        payload_buffer[prefix]["PV"] = df
+def scoring_batch_due(topic, window=None):
+    if not pending_pairs.get(topic):
+        return False
+    window = SCORING_BATCH_WINDOW if window is None else window
+    return time.monotonic() - pending_since[topic] >= window
 
-    if "CSP" in payload_buffer[prefix] and "PV" in payload_buffer[prefix]:
-        logger.info(f"Pair found for tag prefix: {prefix}. Proceeding to merge and detect.")
-        sp_df = payload_buffer[prefix].pop("CSP")
-        pv_df = payload_buffer[prefix].pop("PV")
-        
-        outdoor_df = outdoor_buffer.get(subsystem)
 
-        payload_yay = try_merge_and_detect(sp_df, pv_df, prefix, mode, topic, outdoor_df=outdoor_df)
+def scoring_batch_remaining(topic, window=None):
+    if not pending_pairs.get(topic):
+        return None
+    window = SCORING_BATCH_WINDOW if window is None else window
+    return max(0.0, window - (time.monotonic() - pending_since[topic]))
 
-        if not payload_buffer[prefix]:
-            del payload_buffer[prefix]
-            logger.info(f"Cleared buffer for tag prefix: {prefix}")
 
-        return payload_yay
\ No newline at end of file
+def take_scoring_batch(topic):
+    pending_since.pop(topic, None)
+    pairs = pending_pairs.pop(topic, [])
+    if pairs:
+        logger.info("Topic: %s, scoring batch of %s pairs", topic, len(pairs))
+    return pairs
\ No newline at end of file
@@ -0,0 +1,210 @@
+import os
+import shutil
+import time
+import numpy as np
+import pandas as pd
+from logger_config import setup_logger
+from storage import RECORD_DTYPE, atomic_write, results_to_records
+
+logger = setup_logger(__name__)
+
+# Long-term history kept next to the rolling live store: one directory per topic and UTC day
+HISTORY_ENABLED = os.getenv("HISTORY_ENABLED", "true").lower() == "true"
+HISTORY_DIR = os.getenv("HISTORY_DIR", "history")
+HISTORY_SEGMENT_ROWS = int(os.getenv("HISTORY_SEGMENT_ROWS", 5000))  # rows buffered before a segment is written
+HISTORY_SEGMENT_SECONDS = float(os.getenv("HISTORY_SEGMENT_SECONDS", 60))  # oldest buffered row age that forces one
+HISTORY_RETENTION_DAYS = int(os.getenv("HISTORY_RETENTION_DAYS", 90))  # 0 keeps everything
+
+# Fixed-width anomaly index, appended as anomalies are flushed so pages can be found by offset
+ANOMALY_DTYPE = np.dtype([
+    ("timestamp", "<i8"),
+    ("sensor", "S64"),
+    ("setpoint", "<f8"),
+    ("actual", "<f8"),
+    ("error", "<f8"),
+])
+ANOMALY_INDEX = "anomalies.idx"
+DAY_NS = 86_400 * 1_000_000_000
+
+
+def topic_dir(topic_name, root=HISTORY_DIR):
+    return os.path.join(root, topic_name)
+
+
+def _split_by_day(records):
+    # (day name, records of that UTC day) pairs
+    day_keys = records["timestamp"] // DAY_NS
+    for key in np.unique(day_keys):
+        yield day_of(key * DAY_NS), records[day_keys == key]
+
+
+def day_of(timestamp_ns):
+    return pd.Timestamp(int(timestamp_ns) // DAY_NS * DAY_NS, unit="ns").strftime("%Y-%m-%d")
+
+
+def list_days(topic_name, start_ns=None, end_ns=None, root=HISTORY_DIR):
+    # Day partitions of a topic that can hold rows in the range, oldest first
+    path = topic_dir(topic_name, root)
+    if not os.path.isdir(path):
+        return []
+    days = sorted(d for d in os.listdir(path) if os.path.isdir(os.path.join(path, d)))
+    if start_ns is not None:
+        first = day_of(start_ns)
+        days = [d for d in days if d >= first]
+    if end_ns is not None:
+        last = day_of(end_ns)
+        days = [d for d in days if d <= last]
+    return days
+
+
+class HistoryStore:
+    # Append-only, day-partitioned history of one topic. Rows are buffered and written as
+    # compressed column segments named after their time span, so range queries can skip
+    # whole files by name; anomalies also go straight into a per-day fixed-width index.
+    def __init__(self, topic_name, root=HISTORY_DIR, segment_rows=HISTORY_SEGMENT_ROWS,
+                 segment_seconds=HISTORY_SEGMENT_SECONDS, retention_days=HISTORY_RETENTION_DAYS):
+        self.topic_name = topic_name
+        self.root = root
+        self.path = topic_dir(topic_name, root)
+        self.segment_rows = segment_rows
+        self.segment_seconds = segment_seconds
+        self.retention_days = retention_days
+        self.buffer = []
+        self.buffered = 0
+        self.buffered_since = None
+        os.makedirs(self.path, exist_ok=True)
+
+    def append(self, rows):
+        records = results_to_records(rows)
+        if not len(records):
+            return
+        self._index_anomalies(records[records["anomaly"] == 1])
+        if self.buffered_since is None:
+            self.buffered_since = time.monotonic()
+        self.buffer.append(records)
+        self.buffered += len(records)
+        if self.buffered >= self.segment_rows:
+            self.flush()
+        else:
+            self.flush_if_due(time.monotonic())
+
+    def due_at(self):
+        # When the buffered rows must be written even if no more arrive, None if empty
+        return None if self.buffered_since is None else self.buffered_since + self.segment_seconds
+
+    def flush_if_due(self, now):
+        due = self.due_at()
+        if due is not None and now >= due:
+            self.flush()
+
+    def _index_anomalies(self, records):
+        if not len(records):
+            return
+        for day, chunk in _split_by_day(records):
+            entries = np.zeros(len(chunk), dtype=ANOMALY_DTYPE)
+            for name in ANOMALY_DTYPE.names:
+                entries[name] = chunk[name]
+            day_path = os.path.join(self.path, day)
+            os.makedirs(day_path, exist_ok=True)
+            with open(os.path.join(day_path, ANOMALY_INDEX), "ab") as f:
+                f.write(entries.tobytes())
+
+    def flush(self):
+        if not self.buffer:
+            return
+        records = np.concatenate(self.buffer)
+        self.buffer, self.buffered, self.buffered_since = [], 0, None
+        for day, chunk in _split_by_day(records):
+            chunk = chunk[np.argsort(chunk["timestamp"], kind="stable")]
+            day_path = os.path.join(self.path, day)
+            os.makedirs(day_path, exist_ok=True)
+            name = f"seg-{chunk['timestamp'][0]}-{chunk['timestamp'][-1]}-{os.getpid()}-{time.monotonic_ns()}.npz"
+            with atomic_write(os.path.join(day_path, name)) as f:
+                np.savez_compressed(f, **{field: chunk[field] for field in RECORD_DTYPE.names})
+        self._apply_retention()
+
+    def _apply_retention(self):
+        if self.retention_days <= 0:
+            return
+        cutoff = (pd.Timestamp.now(tz="UTC") - pd.Timedelta(days=self.retention_days)).strftime("%Y-%m-%d")
+        for day in list_days(self.topic_name, root=self.root):
+            if day < cutoff:
+                shutil.rmtree(os.path.join(self.path, day), ignore_errors=True)
+                logger.info("Dropped history partition %s/%s", self.topic_name, day)
+
+    def close(self):
+        self.flush()
+
+
+def _sensor_mask(sensor_column, sensors):
+    return np.isin(sensor_column, [str(s).encode()[:64] for s in sensors])
+
+
+def _read_index(path):
+    # Whole records only; a writer may be midway through appending the last one
+    try:
+        count = os.path.getsize(path) // ANOMALY_DTYPE.itemsize
+    except FileNotFoundError:
+        return np.zeros(0, dtype=ANOMALY_DTYPE)
+    return np.fromfile(path, dtype=ANOMALY_DTYPE, count=count)
+
+
+def anomaly_count(topic_name, root=HISTORY_DIR):
+    # From index file sizes alone
+    total = 0
+    for day in list_days(topic_name, root=root):
+        try:
+            total += os.path.getsize(os.path.join(topic_dir(topic_name, root), day, ANOMALY_INDEX)) // ANOMALY_DTYPE.itemsize
+        except FileNotFoundError:
+            pass
+    return total
+
+
+def query_anomalies(topic_name, offset=0, limit=20, sensors=None, start=None, end=None, root=HISTORY_DIR):
+    # One page of anomalies, newest first. Without a sensor filter, days before the
+    # requested page are skipped by index size, so deep pages cost the same as the first.
+    start_ns = None if start is None else pd.Timestamp(start).value
+    end_ns = None if end is None else pd.Timestamp(end).value
+    page = []
+    remaining_skip = offset
+    for day in reversed(list_days(topic_name, start_ns, end_ns, root)):
+        path = os.path.join(topic_dir(topic_name, root), day, ANOMALY_INDEX)
+        if not sensors and start_ns is None and end_ns is None:
+            try:
+                count = os.path.getsize(path) // ANOMALY_DTYPE.itemsize
+            except FileNotFoundError:
+                continue
+            if remaining_skip >= count:
+                remaining_skip -= count
+                continue
+        entries = _read_index(path)
+        mask = np.ones(len(entries), dtype=bool)
+        if start_ns is not None:
+            mask &= entries["timestamp"] >= start_ns
+        if end_ns is not None:
+            mask &= entries["timestamp"] <= end_ns
+        if sensors:
+            mask &= _sensor_mask(entries["sensor"], sensors)
+        entries = entries[mask]
+        entries = entries[np.argsort(entries["timestamp"], kind="stable")[::-1]]
+        if remaining_skip >= len(entries):
+            remaining_skip -= len(entries)
+            continue
+        entries = entries[remaining_skip:]
+        remaining_skip = 0
+        page.append(entries[:limit - sum(len(p) for p in page)])
+        if sum(len(p) for p in page) >= limit:
+            break
+
+    entries = np.concatenate(page) if page else np.zeros(0, dtype=ANOMALY_DTYPE)
+    return pd.DataFrame({
+        "Timestamp": pd.to_datetime(entries["timestamp"], utc=True),
+        "Sensor": np.char.decode(entries["sensor"]),
+        "SetPoint": entries["setpoint"],
+        "Actual": entries["actual"],
+        "Error": entries["error"],
+    })
+
+
+def open_history(topic_name):
+    return HistoryStore(topic_name)
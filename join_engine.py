@@ -0,0 +1,85 @@
+import numpy as np
+
+# Same gap handling as DataFrame.interpolate(limit=2).bfill(limit=1).ffill(limit=1)
+INTERPOLATE_LIMIT = 2
+EDGE_FILL_LIMIT = 1
+
+
+def sorted_series(series):
+    # (epoch ns, float64 values) in time order; stable, so equal timestamps keep arrival order
+    timestamps, values = series
+    timestamps = np.asarray(timestamps, dtype=np.int64)
+    values = np.asarray(values, dtype=np.float64)
+    if len(timestamps) > 1 and (timestamps[1:] < timestamps[:-1]).any():
+        order = np.argsort(timestamps, kind="stable")
+        timestamps, values = timestamps[order], values[order]
+    return timestamps, values
+
+
+def asof_lookup(ref_timestamps, ref_values, timestamps, tolerance_ns):
+    # Nearest reference value for each timestamp, NaN when none lies within the tolerance.
+    # Same matching as pd.merge_asof(direction="nearest"): ties go to the earlier point.
+    out = np.full(len(timestamps), np.nan)
+    n = len(ref_timestamps)
+    if not n or not len(timestamps):
+        return out
+    right = np.searchsorted(ref_timestamps, timestamps, side="left")
+    left = right - 1
+    has_right = right < n
+    has_left = left >= 0
+    right_diff = np.where(has_right, ref_timestamps[np.minimum(right, n - 1)] - timestamps, np.iinfo(np.int64).max)
+    left_diff = np.where(has_left, timestamps - ref_timestamps[np.maximum(left, 0)], np.iinfo(np.int64).max)
+    pick = np.where(left_diff <= right_diff, left, right)
+    ok = np.minimum(left_diff, right_diff) <= tolerance_ns
+    out[ok] = ref_values[pick[ok]]
+    return out
+
+
+def fill_gaps(column, limit=INTERPOLATE_LIMIT, edge_limit=EDGE_FILL_LIMIT):
+    # In place. Linear interpolation over row positions of the first `limit` NaNs of each
+    # gap (a trailing gap takes the last value), then the last `edge_limit` NaNs of each
+    # remaining gap from the next value, then the first ones from the previous value.
+    missing = np.isnan(column)
+    if not missing.any() or missing.all():
+        return column
+    positions = np.arange(len(column))
+    valid = positions[~missing]
+    gaps = positions[missing]
+    # Position of the last valid value before each gap row, -1 if none
+    previous = np.maximum.accumulate(np.where(missing, -1, positions))[gaps]
+    if limit:
+        fill = (previous >= 0) & (gaps - previous <= limit)
+        column[gaps[fill]] = np.interp(gaps[fill], valid, column[valid])
+    if edge_limit:
+        missing = np.isnan(column)
+        after = np.minimum.accumulate(np.where(missing, len(column), positions)[::-1])[::-1]
+        before = np.maximum.accumulate(np.where(missing, -1, positions))
+        gaps = positions[missing]
+        fill = (after[gaps] < len(column)) & (after[gaps] - gaps <= edge_limit)
+        source = after[gaps[fill]]
+        back_filled = gaps[fill]
+        column[back_filled] = column[source]
+        # ffill runs on the bfilled result; a bfilled row never precedes another gap row
+        gaps = gaps[~fill]
+        fill = (before[gaps] >= 0) & (gaps - before[gaps] <= edge_limit)
+        column[gaps[fill]] = column[before[gaps[fill]]]
+    return column
+
+
+def join_nearest(base, streams, required=None, limit=INTERPOLATE_LIMIT, edge_limit=EDGE_FILL_LIMIT):
+    # Align any number of sorted (timestamps, values) streams onto the base timeline in one
+    # pass: each stream contributes its nearest point within its tolerance, rows where every
+    # `required` column (0 is the base) is missing are dropped, then gaps are filled per
+    # column. Returns the kept base timestamps and one float64 array per column.
+    base_ts, base_values = base
+    columns = np.empty((1 + len(streams), len(base_ts)))
+    columns[0] = base_values
+    for i, (timestamps, values, tolerance_ns) in enumerate(streams, 1):
+        columns[i] = asof_lookup(timestamps, values, base_ts, tolerance_ns)
+    if required:
+        keep = ~np.isnan(columns[list(required)]).all(axis=0)
+        if not keep.all():
+            base_ts, columns = base_ts[keep], columns[:, keep]
+    for column in columns:
+        fill_gaps(column, limit, edge_limit)
+    return base_ts, list(columns)
@@ -1,20 +1,145 @@
+import os
+import json
+import time
+import queue
+import atexit
 import logging
+import logging.handlers
+import threading
 import pytz
 from datetime import datetime, timezone
 
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text").lower()  # text or json
+# Max INFO/DEBUG records per second per logger; warnings and errors are never dropped (0 disables)
+LOG_RATE_LIMIT = float(os.getenv("LOG_RATE_LIMIT", 50))
+
+STOCKHOLM = pytz.timezone("Europe/Stockholm")
+
+
 class StockholmFormatter(logging.Formatter):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._cached_key = None
+        self._cached_time = None
+
     def formatTime(self, record, datefmt=None):
-        stockholm = pytz.timezone("Europe/Stockholm")
-        dt = datetime.fromtimestamp(record.created, tz=timezone.utc).astimezone(stockholm)
-        return dt.strftime(datefmt or "%Y-%m-%d %H:%M:%S")
+        # Records arrive many per second; convert and format each second only once
+        key = (int(record.created), datefmt)
+        if key != self._cached_key:
+            dt = datetime.fromtimestamp(key[0], tz=timezone.utc).astimezone(STOCKHOLM)
+            self._cached_time = dt.strftime(datefmt or "%Y-%m-%d %H:%M:%S")
+            self._cached_key = key
+        return self._cached_time
+
+
+class JsonFormatter(StockholmFormatter):
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        if record.exc_info:
+            entry["exc_info"] = self.formatException(record.exc_info)
+        return json.dumps(entry)
+
+
+class RateLimitFilter(logging.Filter):
+    # Token bucket per logger for the chatty per-message INFO lines
+    def __init__(self, rate=LOG_RATE_LIMIT):
+        super().__init__()
+        self.rate = rate
+        self.tokens = rate
+        self.updated = time.monotonic()
+        self.suppressed = 0
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        if self.rate <= 0 or record.levelno >= logging.WARNING:
+            return True
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens < 1:
+                self.suppressed += 1
+                return False
+            self.tokens -= 1
+            if self.suppressed:
+                record.msg = f"{record.msg} [{self.suppressed} earlier messages suppressed]"
+                self.suppressed = 0
+        return True
+
+
+class _DeferredQueueHandler(logging.handlers.QueueHandler):
+    # The stock QueueHandler formats on the caller's thread; hand the raw record over
+    # instead so message interpolation and time formatting happen on the writer thread.
+    def prepare(self, record):
+        return record
+
+
+def _make_formatter():
+    fmt = "%(asctime)s [%(levelname)s] %(message)s"
+    if LOG_FORMAT == "json":
+        return JsonFormatter(fmt=fmt)
+    return StockholmFormatter(fmt=fmt)
+
+
+_log_queue = queue.SimpleQueue()
+_listener = None
+_listener_lock = threading.Lock()
+
+
+def _start_listener():
+    global _listener
+    with _listener_lock:
+        if _listener is not None:
+            return
+        stream_handler = logging.StreamHandler()
+        stream_handler.setFormatter(_make_formatter())
+        _listener = logging.handlers.QueueListener(_log_queue, stream_handler)
+        _listener.start()
+
+
+def _stop_listener():
+    global _listener
+    with _listener_lock:
+        if _listener is not None:
+            _listener.stop()
+            _listener = None
+
+
+def shutdown_logging():
+    # Write out everything still queued; for processes that exit without running atexit
+    _stop_listener()
+
+
+def _restart_listener_after_fork():
+    # The writer thread does not survive fork(); give forked workers their own
+    global _listener, _log_queue, _listener_lock
+    _listener_lock = threading.Lock()
+    _listener = None
+    _log_queue = queue.SimpleQueue()
+    for handler in _queue_handlers:
+        handler.queue = _log_queue
+    _start_listener()
+
+
+_queue_handlers = []
+atexit.register(_stop_listener)
+os.register_at_fork(after_in_child=_restart_listener_after_fork)
+
 
 def setup_logger(name):
-    handler = logging.StreamHandler()
-    formatter = StockholmFormatter(fmt="%(asctime)s [%(levelname)s] %(message)s")
-    handler.setFormatter(formatter)
+    _start_listener()
+    handler = _DeferredQueueHandler(_log_queue)
+    handler.addFilter(RateLimitFilter())
+    _queue_handlers.append(handler)
 
     logger = logging.getLogger(name)
-    logger.setLevel(logging.INFO)
+    logger.setLevel(LOG_LEVEL)
     logger.addHandler(handler)
     logger.propagate = False
-    return logger
\ No newline at end of file
+    return logger
@@ -0,0 +1,277 @@
+import os
+import copy
+import json
+import time
+import asyncio
+import threading
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from logger_config import setup_logger
+from storage import atomic_write
+
+logger = setup_logger(__name__)
+
+METRICS_PORT = int(os.getenv("METRICS_PORT", 0))  # 0 disables the HTTP endpoint
+METRICS_FILE = os.getenv("METRICS_FILE", "pipeline_stats.json")
+METRICS_INTERVAL = float(os.getenv("METRICS_INTERVAL", 10))
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _label_key(label_names, labels):
+    return tuple(str(labels.get(name, "")) for name in label_names)
+
+
+def _format_labels(label_names, key, extra=()):
+    pairs = [f'{name}="{value}"' for name, value in zip(label_names, key) if value != ""]
+    pairs += [f'{name}="{value}"' for name, value in extra]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name, help_text, label_names=()):
+        self.name = name
+        self.help = help_text
+        self.label_names = tuple(label_names)
+        self.values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = _label_key(self.label_names, labels)
+        with self._lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self):
+        with self._lock:
+            items = list(self.values.items())
+        return [f"{self.name}{_format_labels(self.label_names, key)} {value}" for key, value in items]
+
+    def snapshot(self):
+        with self._lock:
+            return [{"labels": dict(zip(self.label_names, key)), "value": value} for key, value in self.values.items()]
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        key = _label_key(self.label_names, labels)
+        with self._lock:
+            self.values[key] = value
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name, help_text, label_names=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(buckets)
+        self.values = {}  # key -> [bucket counts..., count, sum]
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = _label_key(self.label_names, labels)
+        with self._lock:
+            state = self.values.get(key)
+            if state is None:
+                state = self.values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[i] += 1
+                    break
+            state[-2] += 1
+            state[-1] += value
+
+    def render(self):
+        with self._lock:
+            items = [(key, list(state)) for key, state in self.values.items()]
+        lines = []
+        for key, state in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets, state):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{_format_labels(self.label_names, key, [('le', bound)])} {cumulative}")
+            lines.append(f"{self.name}_bucket{_format_labels(self.label_names, key, [('le', '+Inf')])} {state[-2]}")
+            lines.append(f"{self.name}_count{_format_labels(self.label_names, key)} {state[-2]}")
+            lines.append(f"{self.name}_sum{_format_labels(self.label_names, key)} {state[-1]}")
+        return lines
+
+    def snapshot(self):
+        with self._lock:
+            return [
+                {
+                    "labels": dict(zip(self.label_names, key)),
+                    "count": state[-2],
+                    "sum": state[-1],
+                    "buckets": dict(zip(map(str, self.buckets), state[:len(self.buckets)])),
+                }
+                for key, state in self.values.items()
+            ]
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = {}
+        self.collectors = []
+
+    def _add(self, metric):
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help_text, label_names=()):
+        return self._add(Counter(name, help_text, label_names))
+
+    def gauge(self, name, help_text, label_names=()):
+        return self._add(Gauge(name, help_text, label_names))
+
+    def histogram(self, name, help_text, label_names=(), buckets=LATENCY_BUCKETS):
+        return self._add(Histogram(name, help_text, label_names, buckets))
+
+    def add_collector(self, fn):
+        # fn() is called before every export so gauges owned elsewhere can be refreshed
+        self.collectors.append(fn)
+
+    def _collect(self):
+        for fn in self.collectors:
+            try:
+                fn()
+            except Exception as e:
+                logger.warning("Metrics collector %s failed: %s", fn.__name__, e)
+
+    def render_prometheus(self):
+        self._collect()
+        lines = []
+        for metric in self.metrics.values():
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self):
+        self._collect()
+        return {
+            "time": time.time(),
+            "pid": os.getpid(),
+            "metrics": {
+                metric.name: {"type": metric.kind, "values": metric.snapshot()}
+                for metric in self.metrics.values()
+            },
+        }
+
+
+registry = Registry()
+
+stage_seconds = registry.histogram(
+    "bms_stage_seconds", "Time spent in each pipeline stage", ["stage", "topic", "prefix"]
+)
+messages_total = registry.counter("bms_messages_total", "Messages received", ["topic", "mode"])
+pairs_total = registry.counter("bms_pairs_total", "Completed CSP/PV pairs", ["topic", "mode"])
+dropped_rows_total = registry.counter("bms_dropped_rows_total", "Merged rows dropped for missing CSP and PV", ["topic"])
+anomalies_total = registry.counter("bms_anomalies_total", "Rows flagged as anomalous", ["topic", "prefix"])
+rows_written_total = registry.counter("bms_rows_written_total", "Rows persisted to the topic store", ["topic"])
+buffered_pairs = registry.gauge("bms_buffered_pairs", "Sensor prefixes waiting for their CSP/PV partner")
+
+
+@contextmanager
+def timed(stage, topic="", prefix=""):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        stage_seconds.observe(time.perf_counter() - start, stage=stage, topic=topic or "", prefix=prefix or "")
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = registry.render_prometheus().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_metrics_server(port=METRICS_PORT, host="127.0.0.1"):
+    if not port:
+        return None
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True)
+    thread.start()
+    logger.info("Serving Prometheus metrics on http://%s:%s/metrics", host, port)
+    return server
+
+
+def write_stats_file(path=METRICS_FILE, snapshot=None):
+    with atomic_write(path, "w") as f:
+        json.dump(snapshot or registry.snapshot(), f)
+
+
+def merge_snapshots(snapshots):
+    # One snapshot summing several processes' metrics label set by label (workers own
+    # disjoint topics, so per-topic series do not overlap)
+    merged = {}
+    for snapshot in snapshots:
+        for name, metric in snapshot.get("metrics", {}).items():
+            target = merged.setdefault(name, {"type": metric["type"], "values": {}})
+            for entry in metric.get("values", []):
+                key = tuple(sorted(entry["labels"].items()))
+                current = target["values"].get(key)
+                if current is None:
+                    target["values"][key] = copy.deepcopy(entry)
+                elif "buckets" in entry:
+                    current["count"] += entry["count"]
+                    current["sum"] += entry["sum"]
+                    for bound, count in entry["buckets"].items():
+                        current["buckets"][bound] = current["buckets"].get(bound, 0) + count
+                else:
+                    current["value"] += entry["value"]
+    return {
+        "time": time.time(),
+        "pid": os.getpid(),
+        "workers": len(snapshots),
+        "metrics": {name: {"type": m["type"], "values": list(m["values"].values())} for name, m in merged.items()},
+    }
+
+
+def read_stats_file(path=METRICS_FILE):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+async def publish_stats(path=METRICS_FILE, interval=METRICS_INTERVAL):
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            write_stats_file(path)
+        except OSError as e:
+            logger.warning("Failed to write stats file %s: %s", path, e)
+
+
+def stage_summary(snapshot):
+    # Per-stage totals from a stats snapshot, for display
+    summary = {}
+    histogram = snapshot.get("metrics", {}).get("bms_stage_seconds", {})
+    for entry in histogram.get("values", []):
+        stage = entry["labels"].get("stage", "")
+        totals = summary.setdefault(stage, {"count": 0, "sum": 0.0})
+        totals["count"] += entry["count"]
+        totals["sum"] += entry["sum"]
+    return summary
+
+
+def counter_total(snapshot, name):
+    metric = snapshot.get("metrics", {}).get(name, {})
+    return sum(entry["value"] for entry in metric.get("values", []))
@@ -0,0 +1,157 @@
+import os
+import time
+import threading
+from collections import OrderedDict
+
+import joblib
+from logger_config import setup_logger
+from metrics import registry as metrics_registry, stage_seconds
+
+logger = setup_logger(__name__)
+
+MODEL_CACHE_SIZE = int(os.getenv("MODEL_CACHE_SIZE", 64))
+MODEL_MISSING_TTL = float(os.getenv("MODEL_MISSING_TTL", 30))
+
+
+def model_path(sp_tag):
+    return f"{sp_tag}_model.joblib"
+
+
+def _file_signature(path):
+    # mtime + size is enough to notice a model rewritten by train_model_for_sensor
+    st = os.stat(path)
+    return (st.st_mtime_ns, st.st_size)
+
+
+def _signature_or_none(path):
+    try:
+        return _file_signature(path)
+    except FileNotFoundError:
+        return None
+
+
+class ModelRegistry:
+    def __init__(self, max_size=MODEL_CACHE_SIZE, missing_ttl=MODEL_MISSING_TTL, loader=joblib.load, path_fn=model_path):
+        self.max_size = max_size
+        self.missing_ttl = missing_ttl
+        self.loader = loader
+        self.path_fn = path_fn
+        self._models = OrderedDict()  # sp_tag -> (signature, model)
+        self._missing = {}  # sp_tag -> (time of last failed lookup, file signature then)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.missing_hits = 0
+        self.loads = 0
+        self.evictions = 0
+        self.load_time = 0.0
+
+    def get(self, sp_tag):
+        now = time.monotonic()
+        path = self.path_fn(sp_tag)
+        with self._lock:
+            missing = self._missing.get(sp_tag)
+        # A negative entry only holds while the file is unchanged, so a model trained by
+        # another process (e.g. the backfill pool) is picked up on the next lookup
+        signature = _signature_or_none(path)
+        if missing is not None and now - missing[0] < self.missing_ttl and signature == missing[1]:
+            with self._lock:
+                self.missing_hits += 1
+            return None
+
+        if signature is None:
+            with self._lock:
+                self._missing[sp_tag] = (now, None)
+                self._models.pop(sp_tag, None)
+                self.misses += 1
+            return None
+
+        with self._lock:
+            self._missing.pop(sp_tag, None)
+            cached = self._models.get(sp_tag)
+            if cached is not None and cached[0] == signature:
+                self._models.move_to_end(sp_tag)
+                self.hits += 1
+                return cached[1]
+            self.misses += 1
+
+        start = time.perf_counter()
+        try:
+            model = self.loader(path)
+        except FileNotFoundError:
+            with self._lock:
+                self._missing[sp_tag] = (now, None)
+            return None
+        elapsed = time.perf_counter() - start
+        stage_seconds.observe(elapsed, stage="model_load", prefix=sp_tag.rsplit("_", 1)[0])
+
+        with self._lock:
+            self.loads += 1
+            self.load_time += elapsed
+            self._models[sp_tag] = (signature, model)
+            self._models.move_to_end(sp_tag)
+            while len(self._models) > self.max_size:
+                self._models.popitem(last=False)
+                self.evictions += 1
+        logger.info("Loaded model for %s from %s in %.1f ms", sp_tag, path, elapsed * 1000)
+        return model
+
+    def put(self, sp_tag, model):
+        # Seed the cache with a freshly trained model so the next predict skips the reload
+        try:
+            signature = _file_signature(self.path_fn(sp_tag))
+        except FileNotFoundError:
+            self.invalidate(sp_tag)
+            return
+        with self._lock:
+            self._missing.pop(sp_tag, None)
+            self._models[sp_tag] = (signature, model)
+            self._models.move_to_end(sp_tag)
+            while len(self._models) > self.max_size:
+                self._models.popitem(last=False)
+                self.evictions += 1
+
+    def mark_missing(self, sp_tag):
+        # Treat an unreadable artifact like a missing one until the negative TTL runs out
+        # or the file is rewritten
+        signature = _signature_or_none(self.path_fn(sp_tag))
+        with self._lock:
+            self._models.pop(sp_tag, None)
+            self._missing[sp_tag] = (time.monotonic(), signature)
+
+    def invalidate(self, sp_tag):
+        with self._lock:
+            self._models.pop(sp_tag, None)
+            self._missing.pop(sp_tag, None)
+
+    def clear(self):
+        with self._lock:
+            self._models.clear()
+            self._missing.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "size": len(self._models),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "missing_hits": self.missing_hits,
+                "loads": self.loads,
+                "evictions": self.evictions,
+                "load_time_seconds": self.load_time,
+            }
+
+
+# Process-wide registry shared by every topic consumer
+model_registry = ModelRegistry()
+
+model_cache_gauge = metrics_registry.gauge("bms_model_cache", "Model registry counters", ["stat"])
+
+
+def _collect_model_cache():
+    for stat, value in model_registry.stats().items():
+        model_cache_gauge.set(value, stat=stat)
+
+
+metrics_registry.add_collector(_collect_model_cache)
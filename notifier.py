@@ -1,6 +1,11 @@
 from logger_config import setup_logger
 import os
+import json
 import time
+import queue
+import threading
+import urllib.request
+from metrics import registry as metrics_registry
 
 logger = setup_logger(__name__)
 
@@ -8,6 +13,13 @@ USE_GPIO = os.getenv("USE_GPIO", "false").lower() == "true"
 LED_PIN = int(os.getenv("LED_PIN", 18))
 BUZZER_PIN = int(os.getenv("BUZZER_PIN", 23))
 
+ALERT_SINKS = os.getenv("ALERT_SINKS", "gpio,log")  # comma-separated: gpio, log, webhook
+ALERT_WEBHOOK_URL = os.getenv("ALERT_WEBHOOK_URL", "http://127.0.0.1:8502/alert")
+ALERT_DEBOUNCE_SECONDS = float(os.getenv("ALERT_DEBOUNCE_SECONDS", 60))  # per sensor
+ALERT_COALESCE_SECONDS = float(os.getenv("ALERT_COALESCE_SECONDS", 0.5))
+ALERT_QUEUE_SIZE = int(os.getenv("ALERT_QUEUE_SIZE", 256))
+ALERT_DURATION = float(os.getenv("ALERT_DURATION", 1))
+
 GPIO_AVAILABLE = False
 
 if USE_GPIO:
@@ -20,18 +32,155 @@ if USE_GPIO:
         GPIO_AVAILABLE = True
         logger.info("GPIO setup complete.")
     except (ImportError, RuntimeError) as e:
-        logger.warning(f"Not using GPIO: {e}")
+        logger.warning("Not using GPIO: %s", e)
         GPIO_AVAILABLE = False
 else:
     logger.info("GPIO usage is disabled via USE_GPIO=false")
 
+alerts_total = metrics_registry.counter("bms_alerts_total", "Anomaly alerts by outcome", ["outcome"])
+
+
+class GpioSink:
+    def send(self, alerts):
+        if GPIO_AVAILABLE:
+            logger.info("Activating LED and Buzzer")
+            GPIO.output(LED_PIN, GPIO.HIGH)
+            GPIO.output(BUZZER_PIN, GPIO.HIGH)
+            time.sleep(ALERT_DURATION)
+            GPIO.output(LED_PIN, GPIO.LOW)
+            GPIO.output(BUZZER_PIN, GPIO.LOW)
+        else:
+            logger.info("Mock alert triggered (no GPIO available)")
+
+
+class LogSink:
+    def send(self, alerts):
+        sensors = ", ".join(f"{a['topic']}/{a['sensor']}" for a in alerts)
+        logger.warning("Anomaly alert for %s sensor(s): %s", len(alerts), sensors)
+
+
+class WebhookSink:
+    def __init__(self, url=ALERT_WEBHOOK_URL, timeout=2):
+        self.url = url
+        self.timeout = timeout
+
+    def send(self, alerts):
+        body = json.dumps({"alerts": alerts}).encode()
+        request = urllib.request.Request(self.url, data=body, headers={"Content-Type": "application/json"})
+        with urllib.request.urlopen(request, timeout=self.timeout):
+            pass
+
+
+SINKS = {"gpio": GpioSink, "log": LogSink, "webhook": WebhookSink}
+
+
+def build_sinks(names=ALERT_SINKS):
+    sinks = []
+    for name in (n.strip().lower() for n in names.split(",")):
+        if not name:
+            continue
+        if name not in SINKS:
+            logger.warning("Unknown alert sink: %s", name)
+            continue
+        sinks.append(SINKS[name]())
+    return sinks
+
+
+class AlertDispatcher:
+    # Drives the alert sinks from its own thread. notify() never blocks: repeats for a
+    # sensor inside the debounce window are ignored, bursts are coalesced into a single
+    # actuation, and alerts that find the queue full are dropped and counted.
+    def __init__(self, sinks=None, debounce=ALERT_DEBOUNCE_SECONDS,
+                 coalesce=ALERT_COALESCE_SECONDS, queue_size=ALERT_QUEUE_SIZE):
+        self.sinks = build_sinks() if sinks is None else sinks
+        self.debounce = debounce
+        self.coalesce = coalesce
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.last_alert = {}  # (topic, sensor) -> monotonic time of last accepted alert
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="alert-dispatcher", daemon=True)
+            self._thread.start()
+        return self
+
+    def notify(self, topic, sensor, timestamp=None):
+        now = time.monotonic()
+        key = (topic, sensor)
+        alert = {"topic": topic, "sensor": sensor, "timestamp": None if timestamp is None else str(timestamp)}
+        with self._lock:
+            last = self.last_alert.get(key)
+            if last is not None and now - last < self.debounce:
+                alerts_total.inc(outcome="debounced")
+                return False
+            try:
+                self.queue.put_nowait(alert)
+            except queue.Full:
+                alerts_total.inc(outcome="dropped")
+                return False
+            self.last_alert[key] = now
+        return True
+
+    def _run(self):
+        while True:
+            alert = self.queue.get()
+            if alert is None:
+                return
+            batch = [alert]
+            deadline = time.monotonic() + self.coalesce
+            stop = False
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    alert = self.queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if alert is None:
+                    stop = True
+                    break
+                batch.append(alert)
+
+            alerts_total.inc(len(batch) - 1, outcome="coalesced")
+            self._dispatch(batch)
+            if stop:
+                return
+
+    def _dispatch(self, batch):
+        for sink in self.sinks:
+            try:
+                sink.send(batch)
+            except Exception as e:
+                alerts_total.inc(outcome="failed")
+                logger.warning("Alert sink %s failed: %s", type(sink).__name__, e)
+        alerts_total.inc(outcome="sent")
+
+    def stop(self, timeout=5):
+        if self._thread is not None:
+            try:
+                self.queue.put(None, timeout=timeout)
+            except queue.Full:
+                pass
+            self._thread.join(timeout)
+            self._thread = None
+
+
+_dispatcher = None
+
+
+def get_dispatcher():
+    global _dispatcher
+    if _dispatcher is None:
+        _dispatcher = AlertDispatcher().start()
+    return _dispatcher
+
+
+def notify_anomaly(topic, sensor, timestamp=None):
+    return get_dispatcher().notify(topic, sensor, timestamp)
+
+
 def alert():
-    if GPIO_AVAILABLE:
-        logger.info("Activating LED and Buzzer")
-        GPIO.output(LED_PIN, GPIO.HIGH)
-        GPIO.output(BUZZER_PIN, GPIO.HIGH)
-        time.sleep(1)
-        GPIO.output(LED_PIN, GPIO.LOW)
-        GPIO.output(BUZZER_PIN, GPIO.LOW)
-    else:
-        logger.info("Mock alert triggered (no GPIO available)")
\ No newline at end of file
+    get_dispatcher().notify("manual", "manual")
@@ -0,0 +1,164 @@
+import os
+import time
+from collections import OrderedDict
+
+from ring_buffer import RingBuffer
+from metrics import registry as metrics_registry
+
+# Points kept per CSP/PV stream in the realtime ring buffers
+RING_BUFFER_CAPACITY = int(os.getenv("RING_BUFFER_CAPACITY", 64))
+# Upper bounds on buffered sensor prefixes; the least recently updated entries go first
+PAIR_BUFFER_MAX_ENTRIES = int(os.getenv("PAIR_BUFFER_MAX_ENTRIES", 4096))
+PAIR_BUFFER_MAX_BYTES = int(os.getenv("PAIR_BUFFER_MAX_BYTES", 64 * 1024 * 1024))
+# Seconds a half-complete pair waits for its partner, and an idle prefix is kept around
+PAIR_TTL_SECONDS = float(os.getenv("PAIR_TTL_SECONDS", 900))
+
+pair_evictions_total = metrics_registry.counter(
+    "bms_pair_evictions_total", "Buffered pair entries evicted or expired", ["reason", "mode"]
+)
+pair_buffer_bytes = metrics_registry.gauge("bms_pair_buffer_bytes", "Memory held by the pairing buffers", ["mode"])
+pair_buffer_entries = metrics_registry.gauge("bms_pair_buffer_entries", "Sensor prefixes held by the pairing buffers", ["mode"])
+
+
+class RingPair:
+    # Realtime CSP/PV points for one prefix, kept in fixed-size rings
+    def __init__(self, topic, subsystem, capacity=RING_BUFFER_CAPACITY):
+        self.topic = topic
+        self.subsystem = subsystem
+        self.csp = RingBuffer(capacity)
+        self.pv = RingBuffer(capacity)
+        self.updated = time.monotonic()
+        self.pending_since = None  # when the oldest unread point arrived
+
+    def add(self, side, series):
+        if self.pending_since is None:
+            self.pending_since = time.monotonic()
+        (self.csp if side == "CSP" else self.pv).append(*series)
+
+    def ready(self):
+        return self.csp.unread > 0 and self.pv.unread > 0
+
+    def pending(self):
+        return self.csp.unread > 0 or self.pv.unread > 0
+
+    def take(self):
+        self.pending_since = None
+        return self.csp.take_unread(), self.pv.take_unread()
+
+    @property
+    def nbytes(self):
+        return self.csp.nbytes + self.pv.nbytes
+
+
+class WindowPair:
+    # Historical uploads are whole windows, so they are paired as plain arrays
+    def __init__(self, topic, subsystem):
+        self.topic = topic
+        self.subsystem = subsystem
+        self.streams = {}
+        self.updated = time.monotonic()
+        self.pending_since = None
+
+    def add(self, side, series):
+        if self.pending_since is None:
+            self.pending_since = time.monotonic()
+        self.streams[side] = series
+
+    def ready(self):
+        return "CSP" in self.streams and "PV" in self.streams
+
+    def pending(self):
+        return bool(self.streams)
+
+    def take(self):
+        self.pending_since = None
+        streams, self.streams = self.streams, {}
+        return streams["CSP"], streams["PV"]
+
+    @property
+    def nbytes(self):
+        return sum(a.nbytes for series in self.streams.values() for a in series)
+
+
+class PairBuffer:
+    # Prefix -> pair entry, bounded by entry count and memory. Entries are kept in
+    # update order so eviction and expiry scans start from the stalest prefix.
+    def __init__(self, factory, mode, max_entries=PAIR_BUFFER_MAX_ENTRIES,
+                 max_bytes=PAIR_BUFFER_MAX_BYTES, ttl=PAIR_TTL_SECONDS):
+        self.factory = factory
+        self.mode = mode
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.nbytes = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, prefix):
+        return prefix in self.entries
+
+    def get(self, prefix):
+        return self.entries.get(prefix)
+
+    def add(self, prefix, topic, subsystem, side, series):
+        entry = self.entries.get(prefix)
+        if entry is None:
+            entry = self.entries[prefix] = self.factory(topic, subsystem)
+            before = 0
+        else:
+            self.entries.move_to_end(prefix)
+            before = entry.nbytes
+        entry.topic = topic
+        entry.updated = time.monotonic()
+        entry.add(side, series)
+        self.nbytes += entry.nbytes - before
+        self._enforce_limits()
+        return entry
+
+    def take(self, prefix):
+        entry = self.entries[prefix]
+        before = entry.nbytes
+        pair = entry.take()
+        self.nbytes += entry.nbytes - before
+        return pair
+
+    def pop(self, prefix, reason=None):
+        entry = self.entries.pop(prefix, None)
+        if entry is not None:
+            self.nbytes -= entry.nbytes
+            if reason is not None:
+                pair_evictions_total.inc(reason=reason, mode=self.mode)
+        return entry
+
+    def _enforce_limits(self):
+        # Never evict the entry that was just updated (always last in order)
+        while len(self.entries) > max(self.max_entries, 1):
+            self.pop(next(iter(self.entries)), "entries")
+        while self.nbytes > self.max_bytes and len(self.entries) > 1:
+            self.pop(next(iter(self.entries)), "memory")
+
+    def expired(self, topic, now=None):
+        # Half-complete entries of `topic` that have waited longer than the TTL
+        now = time.monotonic() if now is None else now
+        return [
+            (prefix, entry) for prefix, entry in self.entries.items()
+            if entry.topic == topic and entry.pending_since is not None
+            and now - entry.pending_since >= self.ttl and not entry.ready()
+        ]
+
+    def drop_idle(self, topic, now=None):
+        # Forget prefixes of `topic` that have not been updated for a whole TTL (e.g. misnamed tags)
+        now = time.monotonic() if now is None else now
+        idle = [p for p, e in self.entries.items() if e.topic == topic and now - e.updated >= self.ttl]
+        for prefix in idle:
+            self.pop(prefix, "idle")
+        return len(idle)
+
+    def half_complete(self):
+        return sum(1 for entry in list(self.entries.values()) if entry.pending() and not entry.ready())
+
+    def collect(self):
+        pair_buffer_bytes.set(self.nbytes, mode=self.mode)
+        pair_buffer_entries.set(len(self.entries), mode=self.mode)
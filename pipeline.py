@@ -0,0 +1,83 @@
+import os
+import asyncio
+import multiprocessing
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from logger_config import setup_logger
+from zscore import detach_worker
+
+logger = setup_logger(__name__)
+
+WORKER_POOL = os.getenv("WORKER_POOL", "thread").lower()  # thread, process or inline
+WORKER_POOL_SIZE = int(os.getenv("WORKER_POOL_SIZE", os.cpu_count() or 2))
+MAX_INFLIGHT_PER_TOPIC = int(os.getenv("MAX_INFLIGHT_PER_TOPIC", 4))
+
+
+def create_executor(kind=WORKER_POOL, size=WORKER_POOL_SIZE):
+    if kind == "thread":
+        logger.info("Running merge/train/detect on a thread pool with %s workers", size)
+        return ThreadPoolExecutor(max_workers=size, thread_name_prefix="detect")
+    if kind == "process":
+        logger.info("Running merge/train/detect on a process pool with %s workers", size)
+        # spawn, like the backfill pool: forking here would copy locks held by the metrics,
+        # writer and alert threads into the workers
+        return ProcessPoolExecutor(max_workers=size, mp_context=multiprocessing.get_context("spawn"),
+                                   initializer=detach_worker)
+    if kind == "inline":
+        logger.info("Running merge/train/detect inline on the event loop")
+        return None
+    raise ValueError(f"Unknown WORKER_POOL: {kind}")
+
+
+class TopicPipeline:
+    # Runs CPU-heavy work for one topic on a shared executor. At most `max_inflight`
+    # jobs are outstanding per topic (submit waits for a slot), and results come back
+    # in submission order for each key, e.g. per sensor prefix.
+    def __init__(self, topic_name, executor, max_inflight=MAX_INFLIGHT_PER_TOPIC):
+        self.topic_name = topic_name
+        self.executor = executor
+        self.slots = asyncio.Semaphore(max_inflight)
+        self.pending = OrderedDict()  # key -> deque of futures
+        self.ready = asyncio.Event()
+
+    async def submit(self, key, fn, *args):
+        loop = asyncio.get_running_loop()
+        if self.executor is None:
+            future = loop.create_future()
+            try:
+                future.set_result(fn(*args))
+            except Exception as e:
+                future.set_exception(e)
+            self.pending.setdefault(key, deque()).append(future)
+            self.ready.set()
+            return
+
+        await self.slots.acquire()
+        future = loop.run_in_executor(self.executor, fn, *args)
+        future.add_done_callback(self._on_done)
+        self.pending.setdefault(key, deque()).append(future)
+
+    def _on_done(self, future):
+        self.slots.release()
+        self.ready.set()
+
+    def completed(self):
+        # Results of finished jobs whose predecessors for the same key are also finished
+        self.ready.clear()
+        results = []
+        for key in list(self.pending):
+            futures = self.pending[key]
+            while futures and futures[0].done():
+                future = futures.popleft()
+                try:
+                    results.append(future.result())
+                except Exception as e:
+                    logger.error("%s job for %s failed: %s", self.topic_name, key, e, exc_info=e)
+            if not futures:
+                del self.pending[key]
+        return results
+
+    async def drain(self):
+        for futures in list(self.pending.values()):
+            await asyncio.gather(*futures, return_exceptions=True)
+        return self.completed()
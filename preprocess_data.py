@@ -1,76 +1,91 @@
-from detector import train_model_for_sensor, detect_anomalies_isolation_forest
+from detector import train_model_for_sensor, detect_anomalies_isolation_forest, detect_anomalies_batch, latest_result
+import logging
 import pandas as pd
 from logger_config import setup_logger
-from config import OUTDOOR_TEMP_TAG
+from config import OUTDOOR_TEMP_TAG, uses_outdoor
+from reference_store import OUTDOOR_TOLERANCE_NS
+from join_engine import sorted_series, join_nearest
+from metrics import timed, dropped_rows_total
 
 # Internal buffer to hold CSP and PV payloads per tag
 message_buffer = {}
 logger = setup_logger(__name__)
 
-def try_merge_and_detect(df_sp, df_pv, tag_name, mode, topic_name=None, outdoor_df=None):
-    # Reset index to make 'Timestamp' a column
-    df_sp = df_sp.rename(columns={"Value": f"SetPoint_{tag_name}_CSP"}).reset_index()
-    df_pv = df_pv.rename(columns={"Value": f"Actual_{tag_name}_PV"}).reset_index()
-
-    # Ensure Timestamp is datetime
-    df_sp["Timestamp"] = pd.to_datetime(df_sp["Timestamp"])
-    df_pv["Timestamp"] = pd.to_datetime(df_pv["Timestamp"])
-
-    # Sort by Timestamp
-    df_sp = df_sp.sort_values("Timestamp")
-    df_pv = df_pv.sort_values("Timestamp")
-
-    # Merge with tolerance
-    df = pd.merge_asof(
-        df_sp, df_pv, on="Timestamp",
-        direction="nearest",
-        tolerance=pd.Timedelta("300s")  # Increased from 300s to allow possibility of mismatch of one data point in CSP and PV
-    )
-
-    logger.info(f"[{tag_name}] Merge done. Total rows: {len(df)}. NaN rows (any): {df.isna().any(axis=1).sum()}")
-
-    # Merge the outdoor temperature with relevant data 
-    if topic_name and "heating" in topic_name.lower():
-        if OUTDOOR_TEMP_TAG and outdoor_df is not None and not outdoor_df.empty:
-            outdoor_df = outdoor_df.rename(columns={"Value": "Outdoor_Temperature"}).reset_index()
-            outdoor_df["Timestamp"] = pd.to_datetime(outdoor_df["Timestamp"])
-            outdoor_df = outdoor_df.sort_values("Timestamp")
-            df = pd.merge_asof(df, outdoor_df, on="Timestamp", direction="nearest", tolerance=pd.Timedelta("60s"))
-            logger.info(f"[{tag_name}] Outdoor temp merged. NaN in Outdoor_Temperature: {df['Outdoor_Temperature'].isna().sum()}")
-            logger.info(f"[{tag_name}] Merged outdoor temperature: {OUTDOOR_TEMP_TAG}")
+# CSP and PV may be one data point apart
+PAIR_TOLERANCE_NS = 300 * 1_000_000_000
+
+
+def merge_pair(sp, pv, tag_name, topic_name=None, outdoor=None):
+    with timed("merge", topic_name, tag_name):
+        return _merge_pair(sp, pv, tag_name, topic_name, outdoor)
+
+
+def _merge_pair(sp, pv, tag_name, topic_name=None, outdoor=None):
+    # PV and, for outdoor topics, outdoor temperature are matched onto the CSP timeline and
+    # gap-filled in one NumPy pass; the frame is built once at the end
+    columns = [f"SetPoint_{tag_name}_CSP", f"Actual_{tag_name}_PV"]
+    streams = [(*sorted_series(pv), PAIR_TOLERANCE_NS)]
+
+    # Merge the outdoor temperature with relevant data
+    if uses_outdoor(topic_name):
+        if OUTDOOR_TEMP_TAG and outdoor is not None and len(outdoor[0]):
+            # outdoor is the sorted slice of the shared reference store around this pair
+            streams.append((outdoor[0], outdoor[1], OUTDOOR_TOLERANCE_NS))
+            columns.append("Outdoor_Temperature")
+            logger.info("[%s] Merged outdoor temperature: %s", tag_name, OUTDOOR_TEMP_TAG)
         else:
-            logger.info(f"[{tag_name}] No outdoor temperature payload found for: {OUTDOOR_TEMP_TAG}")
+            logger.info("[%s] No outdoor temperature payload found for: %s", tag_name, OUTDOOR_TEMP_TAG)
 
+    base = sorted_series(sp)
+    # Rows where both CSP and PV are missing are dropped before gaps are filled
+    timestamps, values = join_nearest(base, streams, required=(0, 1))
+    logger.info("[%s] Merge done. Total rows: %s", tag_name, len(base[0]))
 
-    # Drop rows where both CSP and PV are missing
-    before_drop = len(df)
-    df = df.dropna(subset=[f"SetPoint_{tag_name}_CSP", f"Actual_{tag_name}_PV"], how='all')
-    dropped_rows = before_drop - len(df)
-    logger.info(f"[{tag_name}] Dropped rows with both NaNs: {dropped_rows}")
-    
-    # Interpolate only small gaps (limit=2 means max 2 rows filled in a gap)
-    df = df.sort_values("Timestamp").interpolate(limit=2)
+    dropped_rows = len(base[0]) - len(timestamps)
+    if dropped_rows:
+        dropped_rows_total.inc(dropped_rows, topic=topic_name or "")
+    logger.info("[%s] Dropped rows with both NaNs: %s", tag_name, dropped_rows)
 
-    # Fallback to fill single edge NaNs
-    df = df.bfill(limit=1).ffill(limit=1)
+    df = pd.DataFrame({"Timestamp": pd.to_datetime(timestamps, utc=True), **dict(zip(columns, values))})
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("[%s] Interpolation and fill done. Remaining NaNs: %s", tag_name, df.isna().sum().sum())
+    return df
 
-    logger.info(f"[{tag_name}] Interpolation and fill done. Remaining NaNs: {df.isna().sum().sum()}")
 
-    latest_row = None
+def try_merge_and_detect(sp, pv, tag_name, mode, topic_name=None, outdoor=None):
+    df = merge_pair(sp, pv, tag_name, topic_name, outdoor)
+
+    result = None
     if mode == "historical":
         # Handling of Outside temperature value when topic is heating
-        logger.info(f"Historical mode, using data to train model")
-        train_model_for_sensor(df.copy(), f"{tag_name}_CSP", f"{tag_name}_PV", topic_name)       
+        logger.info("Historical mode, using data to train model")
+        train_model_for_sensor(df, f"{tag_name}_CSP", f"{tag_name}_PV", topic_name)       
         
     else:
-        logger.info(f"Real time mode, using data to predict")
-        df_anomaly, has_anomaly = detect_anomalies_isolation_forest(df.copy(), f"{tag_name}_CSP", f"{tag_name}_PV", topic_name)
-        logger.info(f"Anomaly detection completed for tag: {tag_name}")
-        latest_row = df_anomaly[df_anomaly["Timestamp"] == df_anomaly["Timestamp"].max()]
-        logger.info(f"Detection done for pair: {tag_name}, anomalies: {has_anomaly}")
+        logger.info("Real time mode, using data to predict")
+        df_anomaly, has_anomaly = detect_anomalies_isolation_forest(df, f"{tag_name}_CSP", f"{tag_name}_PV", topic_name)
+        logger.info("Anomaly detection completed for tag: %s", tag_name)
+        result = latest_result(df_anomaly, f"{tag_name}_CSP", f"{tag_name}_PV")
+        logger.info("Detection done for pair: %s, anomalies: %s", tag_name, has_anomaly)
 
     if tag_name in message_buffer:
         del message_buffer[tag_name]
-        logger.info(f"Cleared buffer for tag prefix: {tag_name}")
+        logger.info("Cleared buffer for tag prefix: %s", tag_name)
+
+    return result
+
+
+# Micro-batch variant of try_merge_and_detect for realtime pairs that completed in the same window.
+# pairs: list of (sp, pv, tag_name, topic_name, outdoor) series; returns DetectionResults in the same order.
+def merge_and_detect_batch(pairs):
+    merged = []
+    for sp, pv, tag_name, topic_name, outdoor in pairs:
+        df = merge_pair(sp, pv, tag_name, topic_name, outdoor)
+        merged.append((df, f"{tag_name}_CSP", f"{tag_name}_PV", topic_name))
+
+    results = []
+    for (df_anomaly, has_anomaly), (_, sp_tag, pv_tag, _) in zip(detect_anomalies_batch(merged), merged):
+        results.append(latest_result(df_anomaly, sp_tag, pv_tag))
 
-    return latest_row
\ No newline at end of file
+    logger.info("Batched detection done for %s pairs", len(pairs))
+    return results
@@ -0,0 +1,72 @@
+import threading
+import numpy as np
+
+from config import OUTDOOR_TEMP_TAGS, OUTDOOR_TOLERANCE_SECONDS, OUTDOOR_RETENTION_SECONDS, subsystem_of
+from metrics import registry as metrics_registry
+
+reference_points = metrics_registry.gauge("bms_reference_points", "Points held per reference signal", ["tag"])
+
+
+class ReferenceStore:
+    # Process-wide, time-sorted (epoch ns, value) arrays for ambient/reference signals
+    # such as outdoor temperature, shared by every topic. Arrays are replaced, never
+    # modified in place, so readers on worker threads can keep using what they got.
+    def __init__(self, retention_seconds=OUTDOOR_RETENTION_SECONDS):
+        self.retention_ns = int(retention_seconds * 1e9)
+        self._series = {}  # tag -> (timestamps, values)
+        self._lock = threading.Lock()
+        self.listeners = []  # fn(tag, timestamps, values) for points received here, e.g. to share with other processes
+
+    def add(self, tag, timestamps, values, publish=True):
+        timestamps = np.asarray(timestamps, dtype=np.int64)
+        values = np.asarray(values, dtype=np.float32)
+        if publish:
+            for listener in self.listeners:
+                listener(tag, timestamps, values)
+        with self._lock:
+            old_ts, old_values = self._series.get(tag, (timestamps[:0], values[:0]))
+            ts = np.concatenate([old_ts, timestamps])
+            vals = np.concatenate([old_values, values])
+            if len(ts) > 1 and (ts[1:] <= ts[:-1]).any():
+                # Out of order or repeated timestamps: re-sort and keep the newest value per timestamp
+                order = np.argsort(ts, kind="stable")
+                ts, vals = ts[order], vals[order]
+                keep = np.append(ts[1:] != ts[:-1], True)
+                ts, vals = ts[keep], vals[keep]
+            if self.retention_ns and len(ts):
+                start = np.searchsorted(ts, ts[-1] - self.retention_ns, side="left")
+                ts, vals = ts[start:], vals[start:]
+            self._series[tag] = (ts, vals)
+
+    def window(self, tag, start_ns, end_ns, tolerance_ns=0):
+        # Points that can match anything in [start_ns, end_ns] within the tolerance
+        series = self._series.get(tag)
+        if series is None:
+            return None
+        ts, vals = series
+        lo = np.searchsorted(ts, start_ns - tolerance_ns, side="left")
+        hi = np.searchsorted(ts, end_ns + tolerance_ns, side="right")
+        return ts[lo:hi], vals[lo:hi]
+
+    def __len__(self):
+        return len(self._series)
+
+    def collect(self):
+        for tag, (ts, _) in list(self._series.items()):
+            reference_points.set(len(ts), tag=tag)
+
+
+OUTDOOR_TOLERANCE_NS = int(OUTDOOR_TOLERANCE_SECONDS * 1e9)
+# Outdoor sensor per subsystem, so pairs only pick up the outdoor reading of their own building
+OUTDOOR_TAG_BY_SUBSYSTEM = {subsystem_of(tag): tag for tag in sorted(OUTDOOR_TEMP_TAGS)}
+
+reference_store = ReferenceStore()
+metrics_registry.add_collector(reference_store.collect)
+
+
+def outdoor_window(subsystem, timestamps):
+    # The slice of outdoor readings a pair with these timestamps can match; travels with the job
+    tag = OUTDOOR_TAG_BY_SUBSYSTEM.get(subsystem)
+    if tag is None or not len(timestamps):
+        return None
+    return reference_store.window(tag, int(timestamps.min()), int(timestamps.max()), OUTDOOR_TOLERANCE_NS)
@@ -0,0 +1,18 @@
+from typing import NamedTuple
+
+import pandas as pd
+
+
+class DetectionResult(NamedTuple):
+    # Latest scored point of one sensor pair, as emitted by the detector and persisted by
+    # the stores. Field order matches storage.RECORD_DTYPE.
+    timestamp: int  # epoch ns, UTC
+    sensor: str
+    setpoint: float
+    actual: float
+    error: float
+    anomaly: bool
+    outdoor: float  # NaN unless outdoor temperature was merged
+
+    def time(self):
+        return pd.Timestamp(self.timestamp, unit="ns", tz="UTC")
@@ -0,0 +1,69 @@
+import numpy as np
+
+
+class RingBuffer:
+    # Fixed-capacity buffer of (epoch ns, value) points. Every point is written twice,
+    # at i and i + capacity, so the most recent `capacity` points are always one
+    # contiguous slice and can be handed out as views without copying.
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.timestamps = np.zeros(2 * capacity, dtype=np.int64)
+        self.values = np.zeros(2 * capacity, dtype=np.float32)
+        self.head = 0  # next write position in [0, capacity)
+        self.size = 0
+        self.unread = 0
+        self.dropped = 0
+
+    def __len__(self):
+        return self.size
+
+    def append(self, timestamps, values):
+        n = len(timestamps)
+        if n > self.capacity:
+            self.dropped += n - self.capacity
+            timestamps = timestamps[-self.capacity:]
+            values = values[-self.capacity:]
+            n = self.capacity
+        if n == 0:
+            return
+
+        first = min(n, self.capacity - self.head)
+        for offset in (0, self.capacity):
+            start = self.head + offset
+            self.timestamps[start:start + first] = timestamps[:first]
+            self.values[start:start + first] = values[:first]
+            if first < n:
+                self.timestamps[offset:offset + n - first] = timestamps[first:]
+                self.values[offset:offset + n - first] = values[first:]
+
+        self.head = (self.head + n) % self.capacity
+        self.size = min(self.size + n, self.capacity)
+        overwritten = max(0, self.unread + n - self.capacity)
+        self.dropped += overwritten
+        self.unread = min(self.unread + n, self.capacity)
+
+    def view(self, n=None):
+        n = self.size if n is None else min(n, self.size)
+        end = self.head if self.head >= n else self.head + self.capacity
+        return self.timestamps[end - n:end], self.values[end - n:end]
+
+    def take_unread(self):
+        # Views over the points appended since the last call; valid until `capacity` more points arrive
+        n = self.unread
+        self.unread = 0
+        return self.view(n)
+
+    def last(self):
+        if not self.size:
+            return None
+        ts, values = self.view(1)
+        return int(ts[0]), float(values[0])
+
+    def clear(self):
+        self.head = 0
+        self.size = 0
+        self.unread = 0
+
+    @property
+    def nbytes(self):
+        return self.timestamps.nbytes + self.values.nbytes
@@ -1,7 +1,21 @@
 #!/bin/bash
 
-# Start volga_consumer.py in the background
-python3 volga_consumer.py &
+# Start the supervised consumer processes in the background
+python3 supervisor.py &
+SUPERVISOR_PID=$!
 
-# Start the Streamlit dashboard in the foreground
-streamlit run dashboard.py --server.port=8501 --server.address=0.0.0.0
\ No newline at end of file
+# Start the Streamlit dashboard in the background too, so this shell can forward signals
+streamlit run dashboard.py --server.port=8501 --server.address=0.0.0.0 &
+STREAMLIT_PID=$!
+
+# This script runs as PID 1: pass docker stop / Kubernetes termination on so the supervisor
+# can drain its workers instead of being killed at the end of the grace period
+shutdown() {
+    kill -TERM "$SUPERVISOR_PID" "$STREAMLIT_PID" 2>/dev/null
+}
+trap shutdown TERM INT
+
+# The container lives as long as the dashboard, as before; a signal interrupts the wait
+wait "$STREAMLIT_PID"
+shutdown
+wait
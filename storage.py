@@ -0,0 +1,279 @@
+import os
+import mmap
+import time
+import struct
+import numpy as np
+import pandas as pd
+from contextlib import contextmanager
+from logger_config import setup_logger
+
+logger = setup_logger(__name__)
+
+PERSISTENCE_BACKEND = os.getenv("PERSISTENCE_BACKEND", "ring").lower()  # ring or csv
+CSV_EXPORT = os.getenv("CSV_EXPORT", "false").lower() == "true"
+
+RECORD_DTYPE = np.dtype([
+    ("timestamp", "<i8"),
+    ("sensor", "S64"),
+    ("setpoint", "<f8"),
+    ("actual", "<f8"),
+    ("error", "<f8"),
+    ("anomaly", "u1"),
+    ("outdoor", "<f8"),
+])
+
+# magic, version, capacity, generation, head, total rows ever written. While the generation
+# is odd, total already counts the records being written so a crashed write can be found.
+HEADER = struct.Struct("<8sIIQQQ")
+HEADER_SIZE = 64
+MAGIC = b"BMSRING1"
+VERSION = 1
+# Timestamp of slots blanked after a torn write; reads as NaT
+BLANK_TIMESTAMP = np.iinfo(np.int64).min
+
+
+def csv_path(topic_name):
+    return f"{topic_name}.csv"
+
+
+def ring_path(topic_name):
+    return f"{topic_name}.ring"
+
+
+def results_to_records(results):
+    # DetectionResults share RECORD_DTYPE's field order, so they are copied column by column
+    records = np.zeros(len(results), dtype=RECORD_DTYPE)
+    if len(results):
+        columns = list(zip(*results))
+        for name, column in zip(RECORD_DTYPE.names, columns):
+            if name == "sensor":
+                column = [sensor.encode()[:64] for sensor in column]
+            records[name] = column
+    return records
+
+
+def records_to_frame(records):
+    timestamps = pd.to_datetime(records["timestamp"], utc=True)
+    df = pd.DataFrame({
+        "Timestamp": timestamps,
+        "TimeOnly": timestamps.strftime("%H:%M:%S"),
+        "Sensor": np.char.decode(records["sensor"]),
+        "SetPoint": records["setpoint"],
+        "Actual": records["actual"],
+        "Error": records["error"],
+        "Anomaly": records["anomaly"].astype(bool),
+        "Outdoor_Temperature": records["outdoor"],
+    })
+    if df["Outdoor_Temperature"].isna().all():
+        df = df.drop(columns="Outdoor_Temperature")
+    return df
+
+
+@contextmanager
+def atomic_write(path, mode="wb"):
+    # Write next to the final name and swap it in so readers only ever see the old or the new file
+    tmp_path = os.path.join(os.path.dirname(path), f".{os.path.basename(path)}.{os.getpid()}.tmp")
+    try:
+        with open(tmp_path, mode) as f:
+            yield f
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+def write_csv_atomic(df, path):
+    with atomic_write(path, "w") as f:
+        df.to_csv(f, index=False)
+
+
+class CsvStore:
+    # Legacy backend: read, concat, trim and rewrite the whole CSV on every flush
+    def __init__(self, topic_name, capacity):
+        self.topic_name = topic_name
+        self.capacity = capacity
+        self.path = csv_path(topic_name)
+
+    def append(self, rows):
+        df_new = records_to_frame(results_to_records(rows))
+        if os.path.exists(self.path):
+            df_existing = pd.read_csv(self.path)
+            df_combined = pd.concat([df_existing, df_new], ignore_index=True)
+            logger.info("Total rows in %s before combining: %s", self.path, len(df_existing))
+        else:
+            df_combined = df_new
+
+        if len(df_combined) > self.capacity:
+            df_combined = df_combined.tail(self.capacity)
+
+        write_csv_atomic(df_combined, self.path)
+
+    def read(self):
+        return pd.read_csv(self.path)
+
+    def close(self):
+        pass
+
+
+class RingStore:
+    # Fixed-capacity, memory-mapped record file. A flush writes only the new records;
+    # the generation counter is odd while a write is in progress so readers can retry
+    # instead of returning torn data.
+    def __init__(self, topic_name, capacity, csv_export=CSV_EXPORT):
+        self.topic_name = topic_name
+        self.capacity = capacity
+        self.csv_export = csv_export
+        self.path = ring_path(topic_name)
+        self._open()
+
+    def _open(self):
+        size = HEADER_SIZE + self.capacity * RECORD_DTYPE.itemsize
+        existing = None
+        if os.path.exists(self.path):
+            try:
+                if _ring_capacity(self.path) == self.capacity and os.path.getsize(self.path) == size:
+                    self._map(size)
+                    self._recover()
+                    return
+                # Capacity changed: carry the newest rows over into a resized file
+                existing = read_ring(self.path)
+            except ValueError as e:
+                logger.warning("Discarding unreadable ring file %s: %s", self.path, e)
+
+        with atomic_write(self.path) as f:
+            f.write(HEADER.pack(MAGIC, VERSION, self.capacity, 0, 0, 0).ljust(size, b"\0"))
+        self._map(size)
+        if existing is not None and len(existing):
+            self._write(existing)
+
+    def _map(self, size):
+        self._file = open(self.path, "r+b")
+        self._mmap = mmap.mmap(self._file.fileno(), size)
+        self.records = np.ndarray((self.capacity,), dtype=RECORD_DTYPE, buffer=self._mmap, offset=HEADER_SIZE)
+
+    def _header(self):
+        return HEADER.unpack_from(self._mmap, 0)
+
+    def _recover(self):
+        # A writer that died mid-flush left the generation odd. The torn records are not
+        # counted; the ones they overwrote were the oldest live rows and are blanked.
+        _, _, capacity, generation, head, pending = self._header()
+        if not generation % 2:
+            return
+        # head is always total % capacity, and a write covers 1..capacity slots
+        n = (pending - head - 1) % capacity + 1
+        total = pending - n
+        live = min(total, capacity)
+        torn = (head + np.arange(capacity - live, n)) % capacity
+        if len(torn):
+            blank = np.zeros(len(torn), dtype=RECORD_DTYPE)
+            blank["timestamp"] = BLANK_TIMESTAMP
+            for name in ("setpoint", "actual", "error", "outdoor"):
+                blank[name] = np.nan
+            self.records[torn] = blank
+        HEADER.pack_into(self._mmap, 0, MAGIC, VERSION, capacity, generation + 1, head, total)
+        logger.warning("Recovered %s after an interrupted write of %s records, %s older records lost",
+                       self.path, n, len(torn))
+
+    def _write(self, records):
+        _, _, capacity, generation, head, total = self._header()
+        n = len(records)
+        if not n:
+            return
+        if n > capacity:
+            records = records[-capacity:]
+            n = capacity
+
+        HEADER.pack_into(self._mmap, 0, MAGIC, VERSION, capacity, generation + 1, head, total + n)
+        first = min(n, capacity - head)
+        self.records[head:head + first] = records[:first]
+        if first < n:
+            self.records[:n - first] = records[first:]
+        head = (head + n) % capacity
+        HEADER.pack_into(self._mmap, 0, MAGIC, VERSION, capacity, generation + 2, head, total + n)
+
+    def append(self, rows):
+        self._write(results_to_records(rows))
+        if self.csv_export:
+            write_csv_atomic(self.read(), csv_path(self.topic_name))
+
+    def read(self):
+        return records_to_frame(read_ring(self.path))
+
+    def generation(self):
+        return self._header()[3]
+
+    def close(self):
+        self._mmap.close()
+        self._file.close()
+
+
+def _ring_capacity(path):
+    with open(path, "rb") as f:
+        header = f.read(HEADER.size)
+    if len(header) < HEADER.size:
+        return None
+    return HEADER.unpack(header)[2]
+
+
+def read_ring(path, retries=50):
+    # Consistent snapshot of a ring file, oldest record first, without blanked slots
+    records = read_ring_since(path, 0, retries)[0]
+    return records[records["timestamp"] != BLANK_TIMESTAMP]
+
+
+def read_ring_since(path, seen_total, retries=50):
+    # Records appended after the first `seen_total` ever written, oldest first, plus the
+    # new total and the ring capacity. Only the new slots are copied; if the ring has wrapped past what the
+    # caller saw (or was recreated), the whole current contents come back instead.
+    with open(path, "rb") as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            for _ in range(retries):
+                magic, version, capacity, generation, head, total = HEADER.unpack_from(mm, 0)
+                if magic != MAGIC or version != VERSION:
+                    raise ValueError(f"{path} is not a ring store file")
+                if generation % 2:
+                    time.sleep(0.001)
+                    continue
+                fresh = total - seen_total if 0 <= seen_total <= total else total
+                count = min(fresh, total, capacity)
+                records = np.frombuffer(mm, dtype=RECORD_DTYPE, count=capacity, offset=HEADER_SIZE)
+                start = (head - count) % capacity if total >= capacity else total - count
+                if start + count <= capacity:
+                    new = records[start:start + count].copy()
+                else:
+                    new = np.concatenate([records[start:], records[:start + count - capacity]])
+                del records
+                if HEADER.unpack_from(mm, 0)[3] != generation:
+                    continue
+                return new, total, capacity
+    raise ValueError(f"{path} kept changing while being read")
+
+
+def read_generation(topic_name):
+    # Cheap change marker for readers: the ring generation, or the CSV mtime
+    path = ring_path(topic_name)
+    if os.path.exists(path):
+        with open(path, "rb") as f:
+            header = f.read(HEADER.size)
+        if len(header) == HEADER.size:
+            return HEADER.unpack(header)[3]
+    try:
+        return os.path.getmtime(csv_path(topic_name))
+    except FileNotFoundError:
+        return None
+
+
+def store_exists(topic_name):
+    return os.path.exists(ring_path(topic_name)) or os.path.exists(csv_path(topic_name))
+
+
+def open_store(topic_name, capacity, backend=PERSISTENCE_BACKEND):
+    if backend == "csv":
+        return CsvStore(topic_name, capacity)
+    if backend == "ring":
+        return RingStore(topic_name, capacity)
+    raise ValueError(f"Unknown persistence backend: {backend}")
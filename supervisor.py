@@ -0,0 +1,202 @@
+import os
+import time
+import queue
+import signal
+import asyncio
+import threading
+import multiprocessing
+
+from logger_config import setup_logger, shutdown_logging
+from metrics import METRICS_FILE, METRICS_INTERVAL, METRICS_PORT, merge_snapshots, read_stats_file, write_stats_file
+from pipeline import WORKER_POOL_SIZE
+from backfill import BACKFILL_WORKERS
+from reference_store import reference_store
+from zscore import zscore_tracker, ZSCORE_STATE_FILE
+from volga_consumer import login, topics_to_consume, run_topics
+
+logger = setup_logger(__name__)
+
+# Worker processes the topics are sharded across; 0 means one per core (never more than topics)
+CONSUMER_PROCESSES = int(os.getenv("CONSUMER_PROCESSES", 0)) or (os.cpu_count() or 1)
+SUPERVISOR_RESTART_DELAY = float(os.getenv("SUPERVISOR_RESTART_DELAY", 5))  # doubles while a worker keeps crashing
+SUPERVISOR_MAX_RESTART_DELAY = float(os.getenv("SUPERVISOR_MAX_RESTART_DELAY", 120))
+SUPERVISOR_STOP_TIMEOUT = float(os.getenv("SUPERVISOR_STOP_TIMEOUT", 8))  # within the container's shutdown-timeout
+STABLE_SECONDS = 60  # a worker that ran this long before dying restarts without backoff
+
+
+def shard_topics(topic_names, processes):
+    # Round-robin; a topic always belongs to exactly one worker, so its messages are
+    # consumed and persisted in order by a single process
+    n = max(1, min(processes, len(topic_names)))
+    return [topic_names[i::n] for i in range(n)]
+
+
+def worker_stats_path(index):
+    return f"{METRICS_FILE}.{index}"
+
+
+def _apply_reference_points(inbox):
+    # Outdoor readings that arrived on another worker's topics
+    while True:
+        tag, timestamps, values = inbox.get()
+        reference_store.add(tag, timestamps, values, publish=False)
+
+
+async def _worker_main(index, topic_names, session, pool_size, backfill_workers):
+    # SIGTERM cancels the consumers so the writer still flushes on the way out
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+    try:
+        await run_topics(
+            topic_names, session, pool_size=pool_size, backfill_workers=backfill_workers,
+            metrics_port=METRICS_PORT + index if METRICS_PORT else 0, stats_path=worker_stats_path(index),
+        )
+    except asyncio.CancelledError:
+        logger.info("Worker %s stopped", index)
+
+
+def run_worker(index, topic_names, session, inbox, outbox, pool_size, backfill_workers):
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # the supervisor decides when workers stop
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    # A sensor's topic pins it to one worker; each keeps its z-score state in its own file
+    # (merged on load) and picks up what it saved before a restart
+    zscore_tracker.path = f"{ZSCORE_STATE_FILE}.{index}"
+    zscore_tracker.load()
+    reference_store.listeners.append(lambda tag, ts, values: outbox.put((index, tag, ts, values)))
+    threading.Thread(target=_apply_reference_points, args=(inbox,), name="reference-inbox", daemon=True).start()
+    logger.info("Worker %s (pid %s) consuming %s", index, os.getpid(), ", ".join(topic_names))
+    try:
+        asyncio.run(_worker_main(index, topic_names, session, pool_size, backfill_workers))
+    finally:
+        # Forked workers leave through os._exit, which skips atexit handlers
+        zscore_tracker.save()
+        shutdown_logging()
+
+
+class Worker:
+    def __init__(self, index, topic_names):
+        self.index = index
+        self.topic_names = topic_names
+        self.process = None
+        self.inbox = None
+        self.started = 0.0
+        self.restart_at = None
+        self.delay = SUPERVISOR_RESTART_DELAY
+
+    def alive(self):
+        return self.process is not None and self.process.is_alive()
+
+
+class Supervisor:
+    # Forks one consumer process per shard of topics from a parent that logged in once,
+    # so every worker reuses the same Avassa session. Crashed workers are restarted with
+    # backoff, outdoor reference points are relayed between workers, and the workers'
+    # stats files are merged into the one the dashboard reads.
+    def __init__(self, shards, session, stats_path=METRICS_FILE, stats_interval=METRICS_INTERVAL):
+        self.ctx = multiprocessing.get_context("fork")
+        self.session = session
+        self.workers = [Worker(i, topics) for i, topics in enumerate(shards)]
+        self.outbox = self.ctx.Queue()
+        self.stats_path = stats_path
+        self.stats_interval = stats_interval
+        # Share the cores between workers instead of giving each a pool per core
+        self.pool_size = max(1, WORKER_POOL_SIZE // len(shards))
+        self.backfill_workers = max(1, BACKFILL_WORKERS // len(shards))
+        self.stopping = False
+
+    def start(self, worker):
+        worker.inbox = self.ctx.Queue()
+        worker.process = self.ctx.Process(
+            target=run_worker,
+            args=(worker.index, worker.topic_names, self.session, worker.inbox, self.outbox,
+                  self.pool_size, self.backfill_workers),
+            name=f"consumer-{worker.index}",
+        )
+        worker.process.start()
+        worker.started = time.monotonic()
+        worker.restart_at = None
+
+    def check(self, now):
+        for worker in self.workers:
+            if worker.alive():
+                continue
+            if worker.restart_at is None:
+                if now - worker.started >= STABLE_SECONDS:
+                    worker.delay = SUPERVISOR_RESTART_DELAY
+                logger.error("Worker %s (%s) exited with code %s, restarting in %.0fs",
+                             worker.index, ", ".join(worker.topic_names), worker.process.exitcode, worker.delay)
+                worker.restart_at = now + worker.delay
+                worker.delay = min(worker.delay * 2, SUPERVISOR_MAX_RESTART_DELAY)
+            elif now >= worker.restart_at:
+                self.start(worker)
+
+    def relay(self, timeout):
+        # Forward reference points from the worker that received them to all the others
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                sender, tag, timestamps, values = self.outbox.get(timeout=max(0.0, deadline - time.monotonic()))
+            except queue.Empty:
+                return
+            for worker in self.workers:
+                if worker.index != sender and worker.alive():
+                    worker.inbox.put((tag, timestamps, values))
+
+    def publish_stats(self):
+        snapshots = [read_stats_file(worker_stats_path(worker.index)) for worker in self.workers]
+        snapshots = [snapshot for snapshot in snapshots if snapshot]
+        if not snapshots:
+            return
+        try:
+            write_stats_file(self.stats_path, merge_snapshots(snapshots))
+        except OSError as e:
+            logger.warning("Failed to write stats file %s: %s", self.stats_path, e)
+
+    def _stop_requested(self, signum, frame):
+        self.stopping = True
+
+    def run(self):
+        for worker in self.workers:
+            self.start(worker)
+        signal.signal(signal.SIGTERM, self._stop_requested)
+        signal.signal(signal.SIGINT, self._stop_requested)
+        logger.info("Supervising %s consumer processes", len(self.workers))
+
+        next_stats = time.monotonic() + self.stats_interval
+        while not self.stopping:
+            self.relay(timeout=1.0)
+            now = time.monotonic()
+            self.check(now)
+            if now >= next_stats:
+                self.publish_stats()
+                next_stats = now + self.stats_interval
+        self.stop()
+
+    def stop(self):
+        logger.info("Stopping %s consumer processes", len(self.workers))
+        for worker in self.workers:
+            if worker.alive():
+                worker.process.terminate()
+        deadline = time.monotonic() + SUPERVISOR_STOP_TIMEOUT
+        for worker in self.workers:
+            if worker.process is not None:
+                worker.process.join(max(0.0, deadline - time.monotonic()))
+                if worker.process.is_alive():
+                    logger.warning("Worker %s did not stop in time, killing it", worker.index)
+                    worker.process.kill()
+                    worker.process.join()
+        self.publish_stats()
+
+
+def main():
+    topic_names = topics_to_consume()
+    if not topic_names:
+        logger.error("No topics to consume, set TOPICS_TO_CONSUME")
+        return
+    session = login()
+    if session is None:
+        return
+    Supervisor(shard_topics(topic_names, CONSUMER_PROCESSES), session).run()
+
+
+if __name__ == "__main__":
+    main()
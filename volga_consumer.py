@@ -1,32 +1,78 @@
 import os
 import asyncio
-import pandas as pd
 import pytz
-import collections
-import time
 
 from avassa_client import approle_login
 from avassa_client.volga import Consumer, Topic, CreateOptions, Position
 from datetime import datetime, timezone
-from helper import parse_and_store_payload
+from helper import store_payload, run_pair_job, queue_for_scoring, expire_pairs, PAIR_SWEEP_INTERVAL, SCORING_BATCH_WINDOW, scoring_batch_due, scoring_batch_remaining, take_scoring_batch
+from preprocess_data import merge_and_detect_batch
+from pipeline import TopicPipeline, create_executor, WORKER_POOL_SIZE
+from concurrent.futures import ProcessPoolExecutor
+from detector import gate_keys
+from zscore import zscore_tracker, run_detached, Detached
+from backfill import BackfillTrainer, BACKFILL_WORKERS
 from logger_config import setup_logger
+from storage import open_store
+from writer import PersistenceWriter
+from history import open_history, HISTORY_ENABLED
+from notifier import notify_anomaly
+from metrics import messages_total, start_metrics_server, publish_stats, METRICS_PORT, METRICS_FILE
 
 logger = setup_logger(__name__)
 
 max_rows = int(os.getenv("DATA_POINTS_SAVED", 20))  # default to 20 if not set
 write_delay = int(os.getenv("WRITE_DELAY", 20))  # default to 20 if not set
-
-# Utility to flatten payloads
-def process_payload(payload):
-    processed = {}
-    for key, value in payload.items():
-        if isinstance(value, dict) and len(value) == 1:
-            processed[key] = list(value.values())[0]
-        else:
-            processed[key] = value
-    return processed
-
-async def consume_topic(topic_name, session):
+credit_window = max(1, int(os.getenv("CONSUME_CREDIT_WINDOW", 64)))  # messages the server may send ahead of us
+max_batch = int(os.getenv("CONSUME_MAX_BATCH", 256))  # most messages handled in one processing pass
+history_factory = open_history if HISTORY_ENABLED else None
+
+def _next_timeout(topic_name):
+    # Sleep until the next thing that is due: a scoring batch or a pair sweep
+    timeout = PAIR_SWEEP_INTERVAL
+    remaining = scoring_batch_remaining(topic_name)
+    if remaining is not None:
+        timeout = min(timeout, remaining)
+    return timeout
+
+
+async def submit_realtime(pipeline, fn, arg, prefixes):
+    # A process pool gets the consumer's z-score statistics with the job and returns the
+    # points its gate saw; threads share the consumer's tracker directly
+    if isinstance(pipeline.executor, ProcessPoolExecutor):
+        states = zscore_tracker.states([key for prefix in prefixes for key in gate_keys(prefix)])
+        await pipeline.submit("realtime", run_detached, states, fn, arg)
+    else:
+        await pipeline.submit("realtime", fn, arg)
+
+
+async def publish_results(topic_name, completed, writer):
+    # DetectionResults go to the writer as they are
+    results = []
+    for result in completed:
+        if isinstance(result, Detached):
+            zscore_tracker.fold(result.observed)
+            zscore_tracker.maybe_save()
+            result = result.result
+        if isinstance(result, list):
+            results.extend(r for r in result if r is not None)
+        elif result is not None:
+            results.append(result)
+
+    for result in results:
+        if result.anomaly:
+            notify_anomaly(topic_name, result.sensor, result.time())
+    if results:
+        await writer.put(topic_name, results)
+
+
+async def consume_topic(topic_name, session, executor=None, backfill=None, writer=None):
+    recv_task = None
+    ready_task = None
+    pipeline = None
+    own_writer = writer is None
+    if own_writer:
+        writer = PersistenceWriter(lambda name: open_store(name, max_rows), write_delay, open_history=history_factory).start()
     try:
         topic = Topic.local(topic_name)
         async with Consumer(
@@ -37,108 +83,95 @@ async def consume_topic(topic_name, session):
             position=Position.end(),
             on_no_exists=CreateOptions.wait()
         ) as consumer:
-            await consumer.more(1)
-            logger.info(f"Listening on {topic_name}")
-            message_queue = collections.deque()
-            first_message_time = None
+            # We hand out credits ourselves so the server never waits for a round trip
+            await consumer.more(credit_window)
+            logger.info("Listening on %s", topic_name)
+            pipeline = TopicPipeline(topic_name, executor)
             while True:
-                try:
-                    msg = await asyncio.wait_for(consumer.recv(), timeout=2)
-                    msg.setdefault("remain", 0)
-                except asyncio.TimeoutError:
-                    msg = None
-
-                if msg:
-                    logger.info(f"Received raw message on {topic_name}")
+                if recv_task is None:
+                    recv_task = asyncio.ensure_future(consumer.recv(auto_more=0))
+                if ready_task is None:
+                    ready_task = asyncio.ensure_future(pipeline.ready.wait())
+                await asyncio.wait(
+                    {recv_task, ready_task},
+                    timeout=_next_timeout(topic_name),
+                    return_when=asyncio.FIRST_COMPLETED,
+                )
+                if ready_task.done():
+                    ready_task = None
+
+                # Drain everything that is already available into one micro-batch
+                batch = []
+                while recv_task.done() and len(batch) < max_batch:
+                    batch.append(recv_task.result())
+                    recv_task = asyncio.ensure_future(consumer.recv(auto_more=0))
+                    await asyncio.sleep(0)
+
+                if batch:
+                    # A server that does not report remain gets topped up every pass, as before
+                    remain = batch[-1].get("remain", 0)
+                    if remain <= credit_window // 2:
+                        # Hold back credits while storage is behind so the server stops sending
+                        await writer.wait_writable()
+                        await consumer.more(credit_window - remain)
+                    logger.info("Received %s messages on %s", len(batch), topic_name)
+
+                realtime_jobs = []
+                for msg in batch:
                     payload = msg["payload"]
                     mode = payload.get("mode", "realtime")  # default to 'realtime' if not present
+                    messages_total.inc(topic=topic_name, mode=mode)
                     if mode == "historical":
-                        logger.info(f"Received historical data for topic: {topic_name}")
-                        parse_and_store_payload(topic_name, payload, mode)
-                    
-                    else:                        
-                        parsed_payload = parse_and_store_payload(topic_name, payload, mode)
-                        if parsed_payload is not None:
-
-                            processed = process_payload(parsed_payload)
-                            timestamp = processed.get("Timestamp")
-                            try:
-                                time_only = pd.to_datetime(int(timestamp.iloc[0])).strftime("%H:%M:%S")
-                            except:
-                                time_only = pd.Timestamp.now().strftime("%H:%M:%S")
-                            
-                            outdoor_temp = None
-                            if "heating" in topic_name.lower() and "Outdoor_Temperature" in processed:
-                                outdoor_temp = float(processed["Outdoor_Temperature"].iloc[0])
-
-                            sensor_data = {}
-                            for key, value in processed.items():
-                                if key == "Outdoor_Temperature":
-                                    continue  # Already handled separately
-                                if "_" in key:
-                                    prefix, *mid, suffix = key.split("_")
-                                    parts = key.split("_")
-                                    sensor_id = "_".join(parts[1:-1])
-                                    entry = sensor_data.setdefault(sensor_id, {
-                                        "Timestamp": timestamp.iloc[0] if hasattr(timestamp, "iloc") else timestamp,
-                                        "TimeOnly": time_only,
-                                        "Sensor": sensor_id,
-                                        "SetPoint": None,
-                                        "Actual": None,
-                                        "Error": None,
-                                        "Anomaly": None
-                                    })
-                                    if prefix == "SetPoint":
-                                        entry["SetPoint"] = float(value.iloc[0])
-                                    elif prefix == "Actual":
-                                        entry["Actual"] = float(value.iloc[0])
-                                    elif prefix == "Error":
-                                        entry["Error"] = float(value.iloc[0])
-                                    elif prefix == "Anomaly":
-                                        entry["Anomaly"] = str(value).lower() in ["true", "1", "yes"]
-                            if outdoor_temp is not None:
-                                for entry in sensor_data.values():
-                                    entry["Outdoor_Temperature"] = outdoor_temp
-
-
-                            if not message_queue and first_message_time is None:
-                                logger.info(f"{topic_name} queue is empty, setting first message time")
-                                first_message_time = time.time()
-                            message_queue.extend(sensor_data.values())
-                            logger.info(f"{topic_name} queue length: {len(message_queue)}")
-
-                # Always check for flush
-                if first_message_time is not None and message_queue:
-                    time_since_first_message = time.time() - first_message_time
-
-                    if time_since_first_message >= write_delay:
-                        df_new = pd.DataFrame(message_queue)
-                        message_queue.clear()
-
-                        file = topic_name + ".csv"
-                        logger.info(f"{topic_name} flushing {len(df_new)} rows to CSV")
-                        try:
-                            if os.path.exists(file):
-                                df_existing = pd.read_csv(file)
-                                df_combined = pd.concat([df_existing, df_new], ignore_index=True)
-                                logger.info(f"Total rows in {file} before combining: {len(df_existing)}")
-                            else:
-                                df_combined = df_new
-
-                            
-                            if len(df_combined) > max_rows:
-                                df_combined = df_combined.tail(max_rows)
-
-                            df_combined.to_csv(file, index=False)
-                            first_message_time = None
-                            logger.info(f"Wrote {len(df_new)} new rows to {file}, keeping last {max_rows} rows.")
-                        except Exception as e:
-                            logger.error(f"Failed to write or trim {file}: {e}", exc_info=True)
+                        logger.info("Received historical data for topic: %s", topic_name)
 
-    except Exception as e:
-        logger.error(f"Error consuming {topic_name}: {e}", exc_info=True)
+                    # Buffering stays on the loop; merge/train/detect go to the worker pool
+                    job = store_payload(topic_name, payload, mode, copy=True)
+                    if job is None:
+                        continue
+                    if mode == "historical":
+                        if backfill is not None:
+                            backfill.add(job)
+                        else:
+                            await pipeline.submit(job[2], run_pair_job, job)
+                    else:
+                        realtime_jobs.append(job)
+
+                # Half pairs whose partner never came are resolved by the late partner policy
+                realtime_jobs.extend(expire_pairs(topic_name))
+
+                if SCORING_BATCH_WINDOW > 0:
+                    for job in realtime_jobs:
+                        queue_for_scoring(job)
+                elif len(realtime_jobs) == 1:
+                    await submit_realtime(pipeline, run_pair_job, realtime_jobs[0], [realtime_jobs[0][2]])
+                elif realtime_jobs:
+                    # Pairs completed by the same micro-batch are scored in one pass
+                    pairs = [(sp, pv, prefix, topic, outdoor) for sp, pv, prefix, mode, topic, outdoor in realtime_jobs]
+                    await submit_realtime(pipeline, merge_and_detect_batch, pairs, [pair[2] for pair in pairs])
+
+                if scoring_batch_due(topic_name):
+                    pairs = take_scoring_batch(topic_name)
+                    await submit_realtime(pipeline, merge_and_detect_batch, pairs, [pair[2] for pair in pairs])
+
+                await publish_results(topic_name, pipeline.completed(), writer)
 
-async def main():
+    except Exception as e:
+        logger.error("Error consuming %s: %s", topic_name, e, exc_info=True)
+        raise
+    finally:
+        for task in (recv_task, ready_task):
+            if task is not None:
+                task.cancel()
+        if pipeline is not None:
+            # Jobs already handed to the pool still get written and alerted before the writer closes
+            try:
+                await publish_results(topic_name, await pipeline.drain(), writer)
+            except Exception as e:
+                logger.error("Failed to write the last results of %s: %s", topic_name, e)
+        if own_writer:
+            await writer.close()
+
+def login():
     role_id = os.getenv("ROLE_ID")
     secret_id = os.getenv("SECRET_ID")
 
@@ -149,14 +182,48 @@ async def main():
             secret_id=secret_id
         )
         logger.info("Logged into Avassa successfully.")
+        return session
     except Exception as e:
-        logger.error(f"Login failed: {e}")
-        return
+        logger.error("Login failed: %s", e)
+        return None
+
 
+def topics_to_consume():
     topics_env = os.getenv("TOPICS_TO_CONSUME", "")
-    topic_names = [t.strip() for t in topics_env.split(",") if t.strip()]
-    consumers = [consume_topic(name, session) for name in topic_names]
-    await asyncio.gather(*consumers)
+    return [t.strip() for t in topics_env.split(",") if t.strip()]
+
+
+async def run_topics(topic_names, session, pool_size=WORKER_POOL_SIZE, backfill_workers=BACKFILL_WORKERS,
+                     metrics_port=METRICS_PORT, stats_path=METRICS_FILE):
+    executor = create_executor(size=pool_size)
+    backfill = BackfillTrainer(workers=backfill_workers)
+    writer = PersistenceWriter(lambda name: open_store(name, max_rows), write_delay, open_history=history_factory).start()
+    start_metrics_server(metrics_port)
+    consumers = {asyncio.ensure_future(consume_topic(name, session, executor, backfill, writer)): name for name in topic_names}
+    tasks = list(consumers) + [asyncio.ensure_future(publish_stats(stats_path)), asyncio.ensure_future(backfill.serve())]
+    try:
+        # Nothing here finishes while the topics are healthy. Once one does, end the whole
+        # process with its error so a supervisor restarts it instead of keeping a dead topic.
+        done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            task.result()
+        finished = [consumers.get(task, "background task") for task in done]
+        raise RuntimeError(f"{', '.join(finished)} stopped unexpectedly")
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await writer.close()
+        backfill.close()
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+
+async def main():
+    session = login()
+    if session is None:
+        return
+    await run_topics(topics_to_consume(), session)
 
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    asyncio.run(main())
@@ -0,0 +1,187 @@
+import os
+import time
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+from logger_config import setup_logger
+from metrics import registry as metrics_registry, timed, rows_written_total
+
+logger = setup_logger(__name__)
+
+WRITER_QUEUE_SIZE = int(os.getenv("WRITER_QUEUE_SIZE", 1024))  # row batches waiting for the writer
+WRITER_FLUSH_ROWS = int(os.getenv("WRITER_FLUSH_ROWS", 500))  # flush a topic early once this many rows are pending
+WRITER_HIGH_WATERMARK = float(os.getenv("WRITER_HIGH_WATERMARK", 0.75))  # queue fill that counts as congested
+
+writer_queue_depth = metrics_registry.gauge("bms_writer_queue_depth", "Row batches waiting for the persistence writer")
+writer_pending_rows = metrics_registry.gauge("bms_writer_pending_rows", "Rows buffered by the writer, per topic", ["topic"])
+writer_events_total = metrics_registry.counter("bms_writer_events_total", "Persistence writer events", ["event"])
+
+_STOP = object()
+
+
+class PersistenceWriter:
+    # One writer shared by every topic consumer. Consumers hand over rows through a
+    # bounded queue; the writer buffers them per topic and flushes on size or age,
+    # committing every topic with pending rows in the same pass on a dedicated I/O
+    # thread. A full queue blocks put(), and congested() lets consumers stop taking
+    # new messages before that happens.
+    def __init__(self, open_store, flush_delay, flush_rows=WRITER_FLUSH_ROWS, queue_size=WRITER_QUEUE_SIZE,
+                 high_watermark=WRITER_HIGH_WATERMARK, open_history=None):
+        self.open_store = open_store  # topic -> store with append(rows) and path
+        self.open_history = open_history  # topic -> long-term store written alongside, or None
+        self.histories = {}
+        self.flush_delay = flush_delay
+        self.flush_rows = flush_rows
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self.high_watermark = max(1, int(queue_size * high_watermark))
+        self.stores = {}
+        self.pending = {}  # topic -> rows
+        self.pending_since = {}  # topic -> time.monotonic() of the oldest pending row
+        self.io = ThreadPoolExecutor(max_workers=1, thread_name_prefix="persist")
+        self._task = None
+        self._closed = False
+        metrics_registry.add_collector(self._collect)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._run())
+        return self
+
+    def congested(self):
+        return self.queue.qsize() >= self.high_watermark
+
+    async def wait_writable(self):
+        # Consumers call this before granting more credits upstream
+        if not self.congested():
+            return
+        writer_events_total.inc(event="backpressure")
+        logger.warning("Persistence writer is behind (%s batches queued), pausing consumers", self.queue.qsize())
+        while self.congested() and not self._closed:
+            await asyncio.sleep(0.05)
+
+    async def put(self, topic, rows):
+        if self._closed:
+            raise RuntimeError("Persistence writer is closed")
+        if rows:
+            await self.queue.put((topic, rows))
+
+    def _add(self, topic, rows):
+        if topic not in self.pending:
+            self.pending[topic] = []
+            self.pending_since[topic] = time.monotonic()
+        self.pending[topic].extend(rows)
+
+    def _due(self, now):
+        return any(
+            len(rows) >= self.flush_rows or now - self.pending_since[topic] >= self.flush_delay
+            for topic, rows in self.pending.items()
+        )
+
+    def _history_deadlines(self):
+        # Buffered history segments are flushed by age too, so a topic that goes quiet
+        # does not keep its last rows in memory only
+        return [due for due in (history.due_at() for history in list(self.histories.values())) if due is not None]
+
+    def _timeout(self, now):
+        deadlines = [since + self.flush_delay for since in self.pending_since.values()]
+        deadlines += self._history_deadlines()
+        if not deadlines:
+            return None
+        return max(0.0, min(deadlines) - now)
+
+    async def _run(self):
+        stopping = False
+        while not stopping:
+            try:
+                item = await asyncio.wait_for(self.queue.get(), timeout=self._timeout(time.monotonic()))
+            except asyncio.TimeoutError:
+                item = None
+            items = [item] if item is not None else []
+            # Take whatever else is already queued before deciding to flush
+            while not self.queue.empty():
+                items.append(self.queue.get_nowait())
+            for item in items:
+                if item is _STOP:
+                    stopping = True
+                else:
+                    self._add(*item)
+            now = time.monotonic()
+            if self.pending and (stopping or self._due(now)):
+                await self.flush()
+            elif any(due <= now for due in self._history_deadlines()):
+                await asyncio.get_running_loop().run_in_executor(self.io, self._flush_histories)
+
+    async def flush(self):
+        # Group commit: every topic with pending rows goes out in one I/O pass
+        batch, self.pending, self.pending_since = self.pending, {}, {}
+        if batch:
+            await asyncio.get_running_loop().run_in_executor(self.io, self._write, batch)
+
+    def _write(self, batch):
+        writer_events_total.inc(event="commit")
+        for topic, rows in batch.items():
+            try:
+                store = self.stores.get(topic)
+                if store is None:
+                    store = self.stores[topic] = self.open_store(topic)
+                logger.info("%s flushing %s rows to %s", topic, len(rows), store.path)
+                with timed("persist", topic):
+                    store.append(rows)
+                rows_written_total.inc(len(rows), topic=topic)
+            except Exception as e:
+                writer_events_total.inc(event="failed")
+                logger.error("Failed to write %s rows for %s: %s", len(rows), topic, e, exc_info=True)
+            if self.open_history is not None:
+                try:
+                    history = self.histories.get(topic)
+                    if history is None:
+                        history = self.histories[topic] = self.open_history(topic)
+                    with timed("history", topic):
+                        history.append(rows)
+                except Exception as e:
+                    writer_events_total.inc(event="history_failed")
+                    logger.error("Failed to add %s rows to the %s history: %s", len(rows), topic, e, exc_info=True)
+        self._flush_histories()
+
+    def _flush_histories(self):
+        now = time.monotonic()
+        for topic, history in self.histories.items():
+            due = history.due_at()
+            if due is None or now < due:
+                continue
+            try:
+                with timed("history", topic):
+                    history.flush()
+            except Exception as e:
+                writer_events_total.inc(event="history_failed")
+                logger.error("Failed to flush the %s history: %s", topic, e, exc_info=True)
+
+    async def close(self):
+        # Stop taking rows, write everything still queued or pending, release the stores
+        if self._closed:
+            return
+        self._closed = True
+        if self._task is not None:
+            if not self._task.done():
+                await self.queue.put(_STOP)
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        while not self.queue.empty():
+            item = self.queue.get_nowait()
+            if item is not _STOP:
+                self._add(*item)
+        await self.flush()
+        for store in list(self.stores.values()) + list(self.histories.values()):
+            try:
+                store.close()
+            except Exception as e:
+                logger.warning("Failed to close store %s: %s", store.path, e)
+        self.stores.clear()
+        self.histories.clear()
+        self.io.shutdown(wait=True)
+
+    def _collect(self):
+        writer_queue_depth.set(self.queue.qsize())
+        pending = dict(self.pending)
+        for topic in set(self.stores) | set(pending):
+            writer_pending_rows.set(len(pending.get(topic, ())), topic=topic)
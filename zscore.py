@@ -0,0 +1,184 @@
+import os
+import glob
+import time
+import atexit
+import threading
+from collections import defaultdict
+from typing import NamedTuple
+import numpy as np
+
+from logger_config import setup_logger
+from metrics import registry as metrics_registry
+from storage import atomic_write
+
+logger = setup_logger(__name__)
+
+# Cheap per-sensor z-score tier in front of the IsolationForest: rows it considers
+# normal skip the model, except for a sampled fraction. Off by default because the forest
+# also flags rows with an ordinary control error; check recall with benchmark.py --gate
+ZSCORE_GATE = os.getenv("ZSCORE_GATE", "false").lower() == "true"
+ZSCORE_GATE_THRESHOLD = float(os.getenv("ZSCORE_GATE_THRESHOLD", 2.0))
+ZSCORE_SAMPLE_RATE = float(os.getenv("ZSCORE_SAMPLE_RATE", 0.05))
+ZSCORE_WARMUP = int(os.getenv("ZSCORE_WARMUP", 30))  # points before the gate trusts a sensor's statistics
+ZSCORE_ALPHA = float(os.getenv("ZSCORE_ALPHA", 0.01))  # EWMA weight once past 1/alpha points
+ZSCORE_STATE_FILE = os.getenv("ZSCORE_STATE_FILE", "zscore_state.npz")
+ZSCORE_SNAPSHOT_INTERVAL = float(os.getenv("ZSCORE_SNAPSHOT_INTERVAL", 60))
+
+zscore_gate_total = metrics_registry.counter("bms_zscore_gate_total", "Rows seen by the z-score tier by outcome", ["outcome"])
+
+
+class Detached(NamedTuple):
+    # Result of a job run in a pool process, with the points its gate saw per sensor
+    result: object
+    observed: dict
+
+
+class ZScoreTracker:
+    # Running mean/variance of each sensor's control error, updated in O(1) per point.
+    # The first 1/alpha points are exact (Welford); after that it becomes an EWMA so the
+    # baseline follows slow drift. State is snapshotted to a small npz so it survives restarts.
+    # The consumer process owns the state: pool processes are detached, gate on the
+    # statistics handed to them with each job and return the points for the consumer to fold in.
+    def __init__(self, path=ZSCORE_STATE_FILE, alpha=ZSCORE_ALPHA, warmup=ZSCORE_WARMUP,
+                 snapshot_interval=ZSCORE_SNAPSHOT_INTERVAL):
+        self.path = path
+        self.base_path = path
+        self.alpha = alpha
+        self.warmup = warmup
+        self.snapshot_interval = snapshot_interval
+        self.state = {}  # sensor -> [count, mean, var]
+        self.dirty = False
+        self.saved_at = time.monotonic()
+        self.rng = np.random.default_rng()
+        self.observed = None  # sensor -> error arrays seen since seed(), when detached
+        self._lock = threading.Lock()
+        self.load()
+
+    def state_files(self):
+        # The shared file plus the per-process ones written by supervised workers
+        extra = glob.glob(f"{glob.escape(self.base_path)}.*")
+        return [self.base_path] + sorted(p for p in extra if not p.endswith(".tmp"))
+
+    def load(self):
+        # Merge every state file; for a sensor seen by several, the one with most points wins
+        loaded = 0
+        for path in self.state_files():
+            try:
+                with np.load(path) as data:
+                    sensors, values = data["sensors"], data["state"]
+            except FileNotFoundError:
+                continue
+            except (OSError, ValueError, KeyError) as e:
+                logger.warning("Ignoring unreadable z-score state %s: %s", path, e)
+                continue
+            with self._lock:
+                for sensor, row in zip(sensors.astype(str), values):
+                    current = self.state.get(str(sensor))
+                    if current is None or row[0] > current[0]:
+                        self.state[str(sensor)] = [float(v) for v in row]
+            loaded += len(sensors)
+        if loaded:
+            logger.info("Loaded z-score state for %s sensors from %s", len(self.state), self.base_path)
+
+    def detach(self):
+        # In a pool process: never persist, and start each job from the consumer's statistics
+        with self._lock:
+            self.path = None
+            self.state = {}
+            self.dirty = False
+            self.observed = defaultdict(list)
+
+    def states(self, sensors):
+        with self._lock:
+            return {sensor: list(self.state[sensor]) for sensor in sensors if sensor in self.state}
+
+    def seed(self, states):
+        with self._lock:
+            self.state = {sensor: list(row) for sensor, row in states.items()}
+            self.observed = defaultdict(list)
+
+    def take_observed(self):
+        with self._lock:
+            observed, self.observed = self.observed, defaultdict(list)
+        return {sensor: np.concatenate(chunks) for sensor, chunks in observed.items()}
+
+    def fold(self, observed):
+        # Points a detached job gated on, applied in the order it saw them
+        for sensor, errors in observed.items():
+            self.update(sensor, errors)
+
+    def save(self):
+        with self._lock:
+            if not self.dirty or self.path is None:
+                return
+            state = {sensor: list(row) for sensor, row in self.state.items()}
+            self.dirty = False
+            self.saved_at = time.monotonic()
+        # Keep sensors another process (or an earlier run) wrote but this one never saw
+        try:
+            with np.load(self.path) as data:
+                for sensor, row in zip(data["sensors"].astype(str), data["state"]):
+                    state.setdefault(sensor, list(row))
+        except (OSError, ValueError, KeyError):
+            pass
+        try:
+            with atomic_write(self.path) as f:
+                np.savez(f, sensors=np.array(list(state), dtype=str),
+                         state=np.array(list(state.values()), dtype=np.float64).reshape(-1, 3))
+        except OSError as e:
+            logger.warning("Failed to save z-score state to %s: %s", self.path, e)
+
+    def maybe_save(self):
+        if self.dirty and self.path is not None and time.monotonic() - self.saved_at >= self.snapshot_interval:
+            self.save()
+
+    def update(self, sensor, errors):
+        # z-score of each point against the statistics before it, then fold it in
+        errors = np.asarray(errors, dtype=np.float64)
+        z = np.zeros(len(errors))
+        warm = np.zeros(len(errors), dtype=bool)
+        with self._lock:
+            if self.observed is not None:
+                self.observed[sensor].append(errors)
+            count, mean, var = self.state.get(sensor, (0.0, 0.0, 0.0))
+            for i, x in enumerate(errors):
+                if count >= self.warmup:
+                    warm[i] = True
+                    z[i] = (x - mean) / np.sqrt(var) if var > 0 else (0.0 if x == mean else np.inf)
+                count += 1
+                weight = max(self.alpha, 1.0 / count)
+                delta = x - mean
+                mean += weight * delta
+                var = (1.0 - weight) * (var + weight * delta * delta)
+            self.state[sensor] = [count, mean, var]
+            self.dirty = True
+        return z, warm
+
+    def gate(self, sensor, errors, threshold=ZSCORE_GATE_THRESHOLD, sample_rate=ZSCORE_SAMPLE_RATE):
+        # Boolean mask of rows that still need the IsolationForest
+        z, warm = self.update(sensor, errors)
+        flagged = np.abs(z) >= threshold
+        sampled = self.rng.random(len(z)) < sample_rate
+        send = flagged | ~warm | sampled
+        zscore_gate_total.inc(int((~warm).sum()), outcome="warmup")
+        zscore_gate_total.inc(int((warm & flagged).sum()), outcome="flagged")
+        zscore_gate_total.inc(int((warm & ~flagged & sampled).sum()), outcome="sampled")
+        zscore_gate_total.inc(int((~send).sum()), outcome="skipped")
+        return send
+
+
+zscore_tracker = ZScoreTracker()
+atexit.register(zscore_tracker.save)
+
+
+def detach_worker():
+    # Pool initializer: the consumer process stays the only owner of the z-score state
+    zscore_tracker.detach()
+
+
+def run_detached(states, fn, *args):
+    # Runs in a pool process: gate on the consumer's statistics for the job's sensors and
+    # hand back the points seen instead of keeping a diverging copy here
+    zscore_tracker.seed(states)
+    result = fn(*args)
+    return Detached(result, zscore_tracker.take_observed())